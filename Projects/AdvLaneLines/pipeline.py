@@ -22,7 +22,17 @@ class LaneFinder(object):
 
     def __call__(self, im):
         undistorted = undistort_img(im, self.M, self.dist)
+        output, _ = self.process(undistorted)
+        return output
 
+    def process(self, undistorted):
+        """
+        Finds the lane in an image which has already been undistorted, without modifying it.
+
+        :param undistorted: RGB image undistorted with `M` and `dist`
+        :return: Tuple containing (output, lane), where `output` is the annotated image and `lane` is a dictionary
+            with keys ['left_fit', 'right_fit', 'curvature', 'dist_from_center', 'prev_fit_used'].
+        """
         color_thresh = colorspace_threshold(
             im=undistorted,
             thresholds=(225,255),
@@ -94,17 +104,26 @@ class LaneFinder(object):
             color = (255, 0, 0)
         new_warp = cv2.circle(new_warp, (w-100, 100), 11, color, -1)
 
+        lane = {
+            'left_fit': [float(c) for c in left_fit],
+            'right_fit': [float(c) for c in right_fit],
+            'curvature': float(np.mean((l_curv, r_curv))),
+            'dist_from_center': float(dist_from_center),
+            'prev_fit_used': prev_info
+          }
+
         # Combine the result with the original image
         if self.debug:
             grad_thresh = n_bitwise_or(hls1_x, hls1_y, hls2_x, hls2_y)
             color_thresh = np.dstack((np.zeros_like(combined_thresh), grad_thresh, color_thresh))*255
-            return cv2.addWeighted(color_thresh, 1, new_warp, 0.3, 0)
+            return cv2.addWeighted(color_thresh, 1, new_warp, 0.3, 0), lane
         else:
-            curv = 'Curvature: %5.2f m' % np.mean((l_curv, r_curv))
+            curv = 'Curvature: %5.2f m' % lane['curvature']
             center = 'Dist From Center: %0.2f m' % dist_from_center
-            output = cv2.putText(undistorted, curv, (100, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (255,)*3)
+            # Draw on a copy, the undistorted frame may be shared with other consumers
+            output = cv2.putText(np.copy(undistorted), curv, (100, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (255,)*3)
             output = cv2.putText(output, center, (100, 130), cv2.FONT_HERSHEY_SIMPLEX, 1, (255,) * 3)
-            return cv2.addWeighted(output, 1, new_warp, 0.4, 0)
+            return cv2.addWeighted(output, 1, new_warp, 0.4, 0), lane
 
     @staticmethod
     def __valid_fit(left, right, l_curv, r_curv):
@@ -115,15 +134,16 @@ class LaneFinder(object):
         return all(checks_passed)
 
 
-if __name__ == '__main__':
-    ret, M, dist, rvecs, tvecs = calibrate_camera('\\camera_cal\\', 9, 6)
-
-    test_im = os.getcwd() + '\\test_images\\test5.jpg'
-    im = cv2.imread(test_im)
-    im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+def perspective_points(xmax, ymax, x_shift=80, shift=100):
+    """
+    Source and destination points of the perspective transform to a top down view of the lane in front of the car.
 
-    ymax, xmax = im.shape[:2]
-    x_shift = 80
+    :param xmax: Width of the image
+    :param ymax: Height of the image
+    :param x_shift: Half the width of the top of the source trapezoid
+    :param shift: Margin of the destination rectangle
+    :return: Tuple containing (src, dst)
+    """
     src = np.float32([
         [0, 720],
         [xmax // 2 - x_shift, 450],
@@ -131,13 +151,24 @@ if __name__ == '__main__':
         [xmax, 720]
     ])
 
-    shift = 100
     dst = np.float32([
         [shift, ymax],
         [shift, shift],
         [xmax - shift, shift],
         [xmax - shift, ymax]
     ])
+    return src, dst
+
+
+if __name__ == '__main__':
+    ret, M, dist, rvecs, tvecs = calibrate_camera('\\camera_cal\\', 9, 6)
+
+    test_im = os.getcwd() + '\\test_images\\test5.jpg'
+    im = cv2.imread(test_im)
+    im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+
+    ymax, xmax = im.shape[:2]
+    src, dst = perspective_points(xmax, ymax)
 
     lane_finder = LaneFinder(M, dist, src, dst, debug=False)
     project_video_output = 'project_video_output.mp4'
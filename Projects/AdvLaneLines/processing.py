@@ -152,6 +152,19 @@ def undistort_img(im, M, dist):
     return cv2.undistort(im, M, dist, None, M)
 
 
+def undistort_maps(M, dist, size):
+    """
+    Precomputes the pixel maps `undistort_img` rebuilds on every call, so a stream of equally sized images can be
+    undistorted with a single `cv2.remap` each.
+
+    :param M: The calibrated distortion matrix
+    :param dist: The Calibrated distortion coefficients
+    :param size: Tuple with the (width, height) of the images
+    :return: Tuple containing (map1, map2) to pass to `cv2.remap`
+    """
+    return cv2.initUndistortRectifyMap(M, dist, None, M, size, cv2.CV_16SC2)
+
+
 def transform_perspective(im, new_size, src, dst, interpolation=cv2.INTER_LINEAR):
     """
     Meant to transform the perspective of a road image to a Top-Down view.
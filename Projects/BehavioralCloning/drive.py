@@ -1,88 +1,68 @@
-import argparse
-import base64
-
-import numpy as np
-import cv2
-import socketio
-import eventlet.wsgi
-from PIL import Image
-from flask import Flask
-from io import BytesIO
-
-from keras.models import model_from_json
-from utils import process_image
-
-# Fix error with Keras and TensorFlow
-import tensorflow as tf
-tf.python.control_flow_ops = tf
-
-
-sio = socketio.Server()
-app = Flask(__name__)
-model = None
-prev_image_array = None
-
-
-@sio.on('telemetry')
-def telemetry(sid, data):
-    # The current steering angle of the car
-    steering_angle = data["steering_angle"]
-    # The current throttle of the car
-    throttle = float(data["throttle"])
-    # The current speed of the car
-    speed = float(data["speed"])
-    # The current image from the center camera of the car
-    imgString = data["image"]
-    image = Image.open(BytesIO(base64.b64decode(imgString)))
-    image_array = np.asarray(image)
-
-    # Pre-processing
-    processed = process_image(image_array)
-    processed = cv2.cvtColor(processed, cv2.COLOR_BGR2HSV)
-    processed = np.expand_dims(processed, 0)
-
-    steering_angle = float(model.predict(processed, batch_size=1))
-
-    if speed < 30: throttle += 0.1
-    else: throttle -= 0.05
-
-    print(steering_angle, throttle)
-    send_control(steering_angle, throttle)
-
-
-@sio.on('connect')
-def connect(sid, environ):
-    print("connect ", sid)
-    send_control(0, 0)
-
-
-def send_control(steering_angle, throttle):
-    sio.emit("steer", data={
-    'steering_angle': steering_angle.__str__(),
-    'throttle': throttle.__str__()
-    }, skip_sid=True)
-
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Remote Driving')
-    parser.add_argument('model', type=str,
-    help='Path to model definition json. Model weights should be on the same path.')
-    args = parser.parse_args()
-    with open(args.model, 'r') as jfile:
-        # NOTE: if you saved the file by calling json.dump(model.to_json(), ...)
-        # then you will have to call:
-        #
-        #   model = model_from_json(json.loads(jfile.read()))\
-        #
-        # instead.
-        model = model_from_json(jfile.read())
-
-    model.compile("adam", "mse")
-    weights_file = args.model.replace('json', 'h5')
-    model.load_weights(weights_file)
-
-    # wrap Flask application with engineio's middleware
-    app = socketio.Middleware(sio, app)
-
-    # deploy as an eventlet WSGI server
+import eventlet
+# Patch before anything imports `threading`, so the server's worker is a green thread which can emit on the
+# socket, and runs the decoding and inference on a native thread with `tpool`
+eventlet.monkey_patch()
+
+import argparse
+
+import socketio
+import eventlet.wsgi
+from eventlet import tpool
+from flask import Flask
+
+from server import SteeringServer, load_model
+
+
+sio = socketio.Server()
+app = Flask(__name__)
+model = None
+server = None
+
+
+@sio.on('telemetry')
+def telemetry(sid, data):
+    # Only hand the message over, so the socket is never blocked by a slow frame
+    server.submit(data)
+
+
+@sio.on('connect')
+def connect(sid, environ):
+    print("connect ", sid)
+    send_control(0, 0)
+
+
+def send_control(steering_angle, throttle):
+    sio.emit("steer", data={
+    'steering_angle': steering_angle.__str__(),
+    'throttle': throttle.__str__()
+    }, skip_sid=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Remote Driving')
+    parser.add_argument('model', type=str,
+    help='Path to model definition json. Model weights should be on the same path.')
+    parser.add_argument('--max-latency', type=float, default=0.1,
+    help='Drop frames which are older than this many seconds before or after the prediction.')
+    parser.add_argument('--report-every', type=int, default=500,
+    help='Print the serving statistics every this many messages.')
+    parser.add_argument('--engine', choices=['keras', 'numpy'], default='keras',
+    help='Run the model with Keras, or with the NumPy forward pass in numpy_model.py.')
+    args = parser.parse_args()
+
+    model = load_model(args.model, args.engine)
+
+    def send_and_report(steering_angle, throttle):
+        send_control(steering_angle, throttle)
+        if server.counts['served'] and server.counts['served'] % args.report_every == 0:
+            print(server.stats())
+
+    server = SteeringServer(model, send_and_report, max_latency=args.max_latency, offload=tpool.execute)
+    server.warmup()
+    server.start()
+
+    # wrap Flask application with engineio's middleware
+    app = socketio.Middleware(sio, app)
+
+    # deploy as an eventlet WSGI server
     eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
\ No newline at end of file
@@ -0,0 +1,174 @@
+import os
+import argparse
+import numpy as np
+import cv2
+from functools import partial
+from multiprocessing import Pool
+
+from utils import load_data, warp_image, warp_batch, process_image, CACHE_ROWS
+
+
+def _decode_frame(im_path, crop, scale):
+    """
+    Reads a camera frame, converts it to HSV, crops it to the rows in `crop` and resizes it by `scale`.
+    """
+    im = cv2.cvtColor(cv2.imread(im_path), cv2.COLOR_BGR2HSV)[crop[0]:crop[1], :]
+    if scale != 1:
+        h, w = im.shape[:2]
+        im = cv2.resize(im, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_AREA)
+    return im
+
+
+def build_frame_cache(paths, out_path, crop=CACHE_ROWS, scale=1.0, n_jobs=None):
+    """
+    Decodes every image once and stores the cropped HSV frames in a single memory-mapped uint8 array,
+    `<out_path>.npy`, with the paths, their modification times and the settings in `<out_path>_index.npz`.
+
+    If a cache with the same settings which holds every path already exists at `out_path`, and none of the images
+    have changed since it was built, it is returned as is.
+
+    :param paths: Image file paths. Duplicates are only stored once.
+    :param out_path: Path of the cache without an extension
+    :param crop: Tuple with the (first, last) rows of the frames to keep. `utils.process_cropped` and
+        `utils.augment_batch` with `cropped=True` expect `CACHE_ROWS`.
+    :param scale: Factor to resize the cropped frames by. E.G. 0.5 stores frames with shape (58, 160, 3).
+    :param n_jobs: Number of processes to decode the images with. Defaults to the number of CPUs.
+    :return: The `FrameCache`
+    """
+    paths = np.unique(np.asarray(paths))
+    mtimes = np.array([os.path.getmtime(p) for p in paths])
+
+    if FrameCache.exists(out_path):
+        cache = FrameCache(out_path)
+        if cache.crop == tuple(crop) and cache.scale == scale and np.all(np.isin(paths, cache.paths)) and \
+                np.array_equal(cache.mtimes[cache.rows(paths)], mtimes):
+            return cache
+
+    first = _decode_frame(paths[0], crop, scale)
+    frames = np.lib.format.open_memmap(out_path + '.npy', mode='w+', dtype=np.uint8,
+                                       shape=(paths.shape[0],) + first.shape)
+
+    with Pool(n_jobs) as pool:
+        decode = partial(_decode_frame, crop=crop, scale=scale)
+        for i, im in enumerate(pool.imap(decode, paths, chunksize=64)):
+            frames[i] = im
+    frames.flush()
+    del frames
+
+    np.savez(out_path + '_index.npz', paths=paths, mtimes=mtimes, crop=np.array(crop), scale=np.array(scale))
+    return FrameCache(out_path)
+
+
+class FrameCache(object):
+    def __init__(self, path):
+        """
+        Read-only view of the frames written by `build_frame_cache`. The frames are memory-mapped, so batches are
+        gathered straight from the page cache instead of being decoded.
+
+        :param path: Path of the cache without an extension
+        """
+        self.path = path
+        with np.load(path + '_index.npz') as index:
+            self.paths = index['paths']
+            # Caches built before the modification times were stored are always rebuilt
+            self.mtimes = index['mtimes'] if 'mtimes' in index.files else np.full(self.paths.shape, np.nan)
+            self.crop = tuple(int(row) for row in index['crop'])
+            self.scale = float(index['scale'])
+        self.frames = np.load(path + '.npy', mmap_mode='r')
+        self._rows = {p: i for i, p in enumerate(self.paths)}
+
+    @staticmethod
+    def exists(path):
+        """
+        Whether a cache has been built at `path`.
+        """
+        return os.path.exists(path + '.npy') and os.path.exists(path + '_index.npz')
+
+    def rows(self, paths):
+        """
+        Returns the row of each path in `frames`.
+
+        :param paths: Image file paths which are in the cache
+        :return: Integer array with the same length as `paths`
+        """
+        return np.array([self._rows[p] for p in paths], dtype=np.int64)
+
+    def gather(self, rows):
+        """
+        Loads the frames in `rows`, in order.
+
+        :param rows: Rows returned by `rows`
+        :return: Array of shape (len(rows), h, w, 3)
+        """
+        return self.frames[rows]
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    # Only send the path to other processes, which map the frames themselves
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+
+def check_augmentation(cache, n=64, seed=0):
+    """
+    Compares the warps of `utils.augment_batch` on cached frames with those of `utils.augment_image` on the full
+    frames they were cut from, for the same flips, shifts, rotations and scaling drawn from a fixed seed. The shadows
+    only change the brightness, so they are left out.
+
+    :param cache: A `FrameCache` built with `crop=CACHE_ROWS`
+    :param n: Number of frames to compare
+    :param seed: Seed for the frames and augmentations
+    :return: Tuple containing (mean absolute difference, largest mean absolute difference of any output row)
+    """
+    assert cache.crop == CACHE_ROWS, 'The cache must hold the rows in CACHE_ROWS.'
+
+    rng = np.random.RandomState(seed)
+    rows = np.sort(rng.choice(len(cache), min(n, len(cache)), replace=False))
+    n = rows.shape[0]
+    flip = rng.uniform(0.0, 1.0, size=n) < 0.5
+    angles = rng.uniform(-1, 1, size=n)
+    zooms = rng.uniform(0.98, 1.02, size=n)
+    x_shifts = rng.randint(-40, 41, size=n)
+    y_shifts = rng.randint(-7, 8, size=n)
+
+    batch = warp_batch(cache.gather(rows), flip, angles, zooms, x_shifts, y_shifts, cropped=True)
+
+    diffs = np.empty(batch.shape[:2])
+    for i, row in enumerate(rows):
+        im = cv2.cvtColor(cv2.imread(cache.paths[row]), cv2.COLOR_BGR2HSV)
+        if flip[i]:
+            im = cv2.flip(im, 1)
+        expected = process_image(warp_image(im, angles[i], zooms[i], x_shifts[i], y_shifts[i]))
+        diffs[i] = np.mean(np.abs(batch[i].astype(np.float32) - expected), axis=(1, 2))
+    return float(np.mean(diffs)), float(np.max(diffs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Frame Cache')
+    parser.add_argument('dirs', nargs='+', help='Directories containing a driving_log.csv.')
+    parser.add_argument('--out', default='frame_cache', help='Path of the cache without an extension.')
+    parser.add_argument('--scale', type=float, default=1.0, help='Factor to resize the cropped frames by.')
+    parser.add_argument('--check', type=int, default=0,
+                        help='Compare the augmentations of this many cached frames with those of the full frames.')
+    parser.add_argument('--tolerance', type=float, default=8.0,
+                        help='Largest mean absolute difference allowed in any row of the checked frames.')
+    args = parser.parse_args()
+
+    all_paths = []
+    for data_dir in args.dirs:
+        data = load_data(data_dir, 'driving_log.csv')
+        all_paths.extend(np.concatenate((data['center'], data['left'], data['right'])))
+
+    frame_cache = build_frame_cache(all_paths, args.out, scale=args.scale)
+    print('Cached %d frames with shape %r in %s.npy' % (len(frame_cache), frame_cache.frames.shape[1:], args.out))
+
+    if args.check:
+        mean_diff, max_row_diff = check_augmentation(frame_cache, args.check)
+        print('Mean absolute difference from augment_image: %.2f, worst row: %.2f' % (mean_diff, max_row_diff))
+        if max_row_diff > args.tolerance:
+            raise SystemExit('The augmentations of the cached frames do not match augment_image within %g.'
+                             % args.tolerance)
@@ -0,0 +1,126 @@
+import os
+import queue
+import ctypes
+import traceback
+import numpy as np
+import multiprocessing as mp
+
+from utils import batch_indices, load_batch
+
+
+def _worker(worker_id, seed, tasks, done, slots, path, cache, augmentor, kwargs):
+    """
+    Loads and augments batches from `tasks` into their shared memory slot until it receives `None`. Puts
+    (slot, n, None) on `done` for every batch, or (slot, None, traceback) if the batch raised.
+    """
+    # The augmentations draw from the global generator, so seed it once per worker
+    np.random.seed(seed + worker_id)
+    images, angles = _slot_views(*slots)
+
+    for slot, batch_x, batch_y in iter(tasks.get, None):
+        try:
+            batch_x, batch_y = augmentor(load_batch(batch_x, path, cache), batch_y, **kwargs)
+            n = batch_x.shape[0]
+            images[slot, :n] = batch_x
+            angles[slot, :n] = batch_y
+        except Exception:
+            done.put((slot, None, traceback.format_exc()))
+        else:
+            done.put((slot, n, None))
+
+
+def _wait_done(done, workers, poll=1.0):
+    """
+    Waits for the next finished batch, raising if a worker failed on it or has died without reporting.
+
+    :return: Tuple containing (slot, n)
+    """
+    while True:
+        try:
+            slot, n, error = done.get(timeout=poll)
+        except queue.Empty:
+            for worker in workers:
+                if not worker.is_alive():
+                    raise RuntimeError('A batch worker exited unexpectedly with code %s.' % worker.exitcode)
+            continue
+
+        if error is not None:
+            raise RuntimeError('A batch worker failed to load a batch:\n' + error)
+        return slot, n
+
+
+def _slot_views(images_buffer, angles_buffer, shape):
+    """
+    Views the shared buffers as arrays of shape (n_slots, slot_size, h, w, ch) and (n_slots, slot_size).
+    """
+    images = np.frombuffer(images_buffer, dtype=np.uint8).reshape(shape)
+    angles = np.frombuffer(angles_buffer, dtype=np.float32).reshape(shape[:2])
+    return images, angles
+
+
+def prefetch_generator(ims, angs, batch_size, augmentor, path, kwargs={}, validation=False, cache=None,
+                       weights=None, n_workers=None, n_slots=None, seed=0):
+    """
+    Drop in replacement for `utils.batch_generator` which loads and augments batches ahead of time in
+    `n_workers` processes.
+
+    The batches are drawn in the same order as `utils.batch_generator` in the calling process, and only
+    the paths, or cache rows, and angles are sent to the workers. Each worker writes its augmented batch
+    straight into one of `n_slots` shared memory slots, so the images are never pickled, and at most
+    `n_slots` batches are prefetched. The batch is copied out of its slot when it is yielded, as Keras
+    queues the batches from its generator thread, and the slot is refilled immediately.
+
+    Worker `i` seeds NumPy's global generator with `seed + i`, so the augmentations of each worker are
+    reproducible. Batches are yielded in the order they finish, which depends on scheduling. If a worker fails
+    on a batch, its traceback is raised from the generator, as is the exit code of a worker which dies.
+
+    :param ims: The filepaths to the images
+    :param angs: The steering angles corresponding to the image paths
+    :param batch_size: The size of batches to generate
+    :param augmentor: A picklable function which takes inputs (images, angles, **kwargs) and returns
+                      (images, angles), with the same image shape for every batch
+    :param path: A filepath which will be appended to the beginning of each image path
+    :param kwargs: A dictionary containing any additional argument-value pairs for the `augmentor`
+    :param validation: A boolean indicating whether or not to expand the orphan batch
+    :param cache: Optional `FrameCache` holding every image in `ims`
+    :param weights: Optional sampling weight of each image. See `utils.batch_generator`.
+    :param n_workers: Number of worker processes. Defaults to the number of CPUs.
+    :param n_slots: Number of batches to prefetch. Defaults to twice `n_workers`.
+    :param seed: Seed of the first worker
+    :return: Generator producing an infinite number of (images, angles) batches
+    """
+    n_workers = n_workers or os.cpu_count()
+    n_slots = n_slots or 2 * n_workers
+
+    if cache is not None:
+        ims = cache.rows([path + im for im in ims])
+
+    # Augment a single image to find the shape of the output, and how many images each input becomes
+    probe_x, _ = augmentor(load_batch(ims[:1], path, cache), angs[:1], **kwargs)
+    shape = (n_slots, batch_size * probe_x.shape[0]) + probe_x.shape[1:]
+
+    images_buffer = mp.RawArray(ctypes.c_uint8, int(np.prod(shape)))
+    angles_buffer = mp.RawArray(ctypes.c_float, shape[0] * shape[1])
+    images, angles = _slot_views(images_buffer, angles_buffer, shape)
+
+    tasks, done = mp.Queue(), mp.Queue()
+    workers = [mp.Process(target=_worker, daemon=True,
+                          args=(i, seed, tasks, done, (images_buffer, angles_buffer, shape), path, cache,
+                                augmentor, kwargs))
+               for i in range(n_workers)]
+    for worker in workers:
+        worker.start()
+
+    batches = batch_indices(ims, angs, batch_size, validation, weights)
+    try:
+        for slot in range(n_slots):
+            tasks.put((slot,) + next(batches))
+
+        while True:
+            slot, n = _wait_done(done, workers)
+            batch_x, batch_y = images[slot, :n].copy(), angles[slot, :n].copy()
+            tasks.put((slot,) + next(batches))
+            yield batch_x, batch_y
+    finally:
+        for worker in workers:
+            worker.terminate()
@@ -0,0 +1,104 @@
+import os
+import argparse
+import numpy as np
+
+from utils import load_data, transform_ang
+
+
+# Camera codes stored in the index
+CAMERAS = ['center', 'left', 'right']
+
+
+def build_log_index(dirs, out_path, file='driving_log.csv'):
+    """
+    Parses the driving log of every run once and writes a compact index of every camera frame to `<out_path>.npz`.
+
+    Each frame of the logs becomes three samples, one per camera, with the angle of the side cameras already
+    transformed by `utils.transform_ang`. The index holds the arrays:
+        `paths`: Image file path of each sample
+        `camera`: Index into `CAMERAS` of each sample
+        `angles`: Steering angle of each sample, transformed to its camera
+        `run`: Index into `runs` of the run each sample came from
+        `frame`: Row of the sample's frame in its driving log
+        `runs`: The directories of the runs
+        `mtimes`: Modification time of the driving log of each run
+
+    :param dirs: Directories containing a driving log
+    :param out_path: Path of the index without an extension
+    :param file: The name of the driving logs
+    :return: The index, as a dictionary of the arrays above
+    """
+    paths, camera, angles, run, frame = [], [], [], [], []
+    for i, data_dir in enumerate(dirs):
+        data = load_data(data_dir, file)
+        n = data['angles'].shape[0]
+
+        paths.extend((data['center'], data['left'], data['right']))
+        angles.extend((data['angles'], transform_ang(data['angles'], 'left'), transform_ang(data['angles'], 'right')))
+        camera.append(np.repeat(np.arange(len(CAMERAS), dtype=np.uint8), n))
+        run.append(np.full(3*n, i, dtype=np.uint16))
+        frame.append(np.tile(np.arange(n, dtype=np.int32), 3))
+
+    index = {
+        'paths': np.concatenate(paths),
+        'camera': np.concatenate(camera),
+        'angles': np.concatenate(angles).astype(np.float32),
+        'run': np.concatenate(run),
+        'frame': np.concatenate(frame),
+        'runs': np.array(dirs),
+        'mtimes': np.array([os.path.getmtime(d + file) for d in dirs])
+      }
+    np.savez(out_path + '.npz', **index)
+    return index
+
+
+def load_log_index(dirs, out_path, file='driving_log.csv'):
+    """
+    Loads the index at `out_path`, rebuilding it with `build_log_index` if it does not exist, covers different
+    runs, or any of the driving logs have changed since it was built.
+
+    :param dirs: Directories containing a driving log
+    :param out_path: Path of the index without an extension
+    :param file: The name of the driving logs
+    :return: The index, as a dictionary of arrays. See `build_log_index`.
+    """
+    if os.path.exists(out_path + '.npz'):
+        with np.load(out_path + '.npz') as f:
+            index = dict(f)
+        mtimes = np.array([os.path.getmtime(d + file) for d in dirs])
+        if list(index['runs']) == list(dirs) and np.array_equal(index['mtimes'], mtimes):
+            return index
+    return build_log_index(dirs, out_path, file)
+
+
+def run_data(index, data_dir):
+    """
+    Selects one run from the index in the format of `utils.load_data`, along with the transformed angles of the side
+    cameras, so it can be passed to `utils.concat_all_cameras`.
+
+    :param index: Index from `load_log_index`
+    :param data_dir: Directory of the run
+    :return: Dictionary with keys ['angles', 'center', 'left', 'right', 'left_angles', 'right_angles']
+    """
+    run = list(index['runs']).index(data_dir)
+    in_run = index['run'] == run
+
+    data = {}
+    for i, camera in enumerate(CAMERAS):
+        mask = in_run & (index['camera'] == i)
+        order = np.argsort(index['frame'][mask], kind='stable')
+        data[camera] = index['paths'][mask][order]
+        data[camera + '_angles'] = index['angles'][mask][order]
+
+    data['angles'] = data.pop('center_angles')
+    return data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Driving Log Index')
+    parser.add_argument('dirs', nargs='+', help='Directories containing a driving_log.csv.')
+    parser.add_argument('--out', default='log_index', help='Path of the index without an extension.')
+    args = parser.parse_args()
+
+    index = build_log_index(args.dirs, args.out)
+    print('Indexed %d images from %d runs in %s.npz' % (index['paths'].shape[0], len(args.dirs), args.out))
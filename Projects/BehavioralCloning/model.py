@@ -14,6 +14,10 @@ from glob import glob
 from sklearn.utils import shuffle
 import utils
 import matplotlib.pyplot as plt
+from frame_cache import build_frame_cache
+from loader import prefetch_generator
+from log_index import load_log_index, run_data
+from sampler import angle_weights
 
 from keras.models import Sequential
 from keras.layers.core import Dense, Dropout, Flatten, Lambda
@@ -45,7 +49,7 @@ Parameters = namedtuple('Parameters', [
     # Optimizer settings
     'learning_rate', 'epsilon', 'decay',
     # Training settings
-    'min_delta', 'patience', 'kwargs'
+    'min_delta', 'patience', 'kwargs', 'angle_balance'
   ])
 
 params = Parameters(
@@ -56,27 +60,33 @@ params = Parameters(
     # Optimizer settings
     learning_rate=7e-4, epsilon=1e-8, decay=0.0,
     # Training settings
-    min_delta=1e-4, patience=4, kwargs={'prob': 1.0}
+    min_delta=1e-4, patience=4, kwargs={'prob': 1.0, 'cropped': True}, angle_balance=0.5
   )
 
 
 path = '/home/japata/sharefolder/CarND/Projects/BehavioralCloning/'
 
+# Parse the driving logs once, and reuse the index until one of them changes
+index = load_log_index(
+    dirs=[path + 'UdacityData/', path + 'Data/Center/', path + 'Data/Left/', path + 'Data/Right/'],
+    out_path=path + 'log_index'
+  )
+
 # Load Udacity's Data
+# Keep every frame, the straight frames are down-weighted by the sampler instead
 udacity_paths, udacity_angs = utils.concat_all_cameras(
-    data=utils.load_data(path + 'UdacityData/', 'driving_log.csv'),
+    data=run_data(index, path + 'UdacityData/'),
     angle_shift=params.angle_shift,
     condition_lambda=lambda x: abs(x) < 1e-5,
-    keep_percent=0.2
+    keep_percent=1.0
   )
 
 # Load the data from the middle runs
-# Remove 90% of the frames where the steering angle is close to zero
 center_paths, center_angs = utils.concat_all_cameras(
-    data=utils.load_data(path + 'Data/Center/', 'driving_log.csv'),
+    data=run_data(index, path + 'Data/Center/'),
     angle_shift=params.angle_shift,
     condition_lambda=lambda x: abs(x) < 1e-5,
-    keep_percent=0.2
+    keep_percent=1.0
   )
 
 # Load the data from the left runs
@@ -84,7 +94,7 @@ center_paths, center_angs = utils.concat_all_cameras(
 # This effectively only keeps the frames where the car is recovering from
 # the left edge.
 left_paths, left_angs = utils.concat_all_cameras(
-    data=utils.load_data(path + 'Data/Left/', 'driving_log.csv'),
+    data=run_data(index, path + 'Data/Left/'),
     angle_shift=params.angle_shift,
     condition_lambda=lambda x: x < 1e-5,
     keep_percent=0.0,
@@ -96,7 +106,7 @@ left_paths, left_angs = utils.concat_all_cameras(
 # This effectively only keeps the frames where the car is recovering from
 # the right edge.
 right_paths, right_angs = utils.concat_all_cameras(
-    data=utils.load_data(path + 'Data/Right/', 'driving_log.csv'),
+    data=run_data(index, path + 'Data/Right/'),
     angle_shift=params.angle_shift,
     condition_lambda=lambda x: x > -1e-5,
     keep_percent=0.0,
@@ -115,6 +125,19 @@ train_paths, val_paths, train_angs, val_angs = utils.split_data(
 
 print('Training size: %d | Validation size: %d' % (train_paths.shape[0], val_paths.shape[0]))
 
+# Decode every frame once, instead of once per epoch
+frames = build_frame_cache(np.concatenate((train_paths, val_paths)), path + 'frame_cache')
+
+# The validation set never changes, so normalize and flip it once
+val_ims, val_angs = utils.validation_set(ims=val_paths, angs=val_angs, path=params.path, cache=frames,
+                                         im_normalizer=utils.process_cropped)
+
+# Weight the validation loss with the same rebalancing the training epochs are sampled with, so the near straight
+# frames kept in the split do not dominate `val_loss`, and with it the early stopping and checkpoints. The weights
+# come from the training histogram, the one the epochs are drawn from.
+val_weights = angle_weights(val_angs, power=params.angle_balance, reference=train_angs)
+val_weights *= val_weights.shape[0] / np.sum(val_weights)
+
 
 # Model construction
 model = Sequential([
@@ -195,16 +218,18 @@ callbacks = [
   ]
 
 model.fit_generator(
-    generator=utils.batch_generator(ims=train_paths, angs=train_angs, batch_size=params.batch_size,
-                                    augmentor=utils.augment_image, path=params.path, kwargs=params.kwargs),
+    # Augment the training batches ahead of time in a pool of worker processes
+    generator=prefetch_generator(ims=train_paths, angs=train_angs, batch_size=params.batch_size,
+                                 augmentor=utils.augment_batch, path=params.path, kwargs=params.kwargs,
+                                 cache=frames,
+                                 # Rebalance the steering angles of each epoch rather than discarding frames
+                                 weights=angle_weights(train_angs, power=params.angle_balance)),
     samples_per_epoch=25600,
     nb_epoch=params.max_epochs,
-    # Halve the batch size, as `utils.val_augmentor` doubles the batch size by flipping the images and angles
-    validation_data=utils.batch_generator(ims=val_paths, angs=val_angs, batch_size=params.batch_size//2,
-                                          augmentor=utils.val_augmentor, validation=True, path=params.path),
-    # Double the size of the validation set, as we are flipping the images to balance the right/left
-    # distribution.
-    nb_val_samples=2*udacity_angs.shape[0],
+    # Each validation image and its flipped copy, to balance the right/left distribution. Passed as a generator,
+    # so it is evaluated at the training batch size rather than whatever size Keras picks for arrays.
+    validation_data=utils.array_batches((val_ims, val_angs, val_weights), params.batch_size),
+    nb_val_samples=val_ims.shape[0],
     callbacks=callbacks
   )
 
@@ -0,0 +1,332 @@
+import json
+import argparse
+
+import numpy as np
+import h5py
+from numpy.lib.stride_tricks import as_strided
+
+
+def _activation(name):
+    """
+    Returns an in-place version of a Keras activation, which takes a buffer and a scratch buffer of the same shape.
+    """
+    def linear(x, tmp):
+        return x
+
+    def relu(x, tmp):
+        return np.maximum(x, 0, out=x)
+
+    def elu(x, tmp):
+        # elu(x) = max(x, 0) + expm1(min(x, 0))
+        np.minimum(x, 0, out=tmp)
+        np.expm1(tmp, out=tmp)
+        np.maximum(x, 0, out=x)
+        x += tmp
+        return x
+
+    def tanh(x, tmp):
+        return np.tanh(x, out=x)
+
+    def sigmoid(x, tmp):
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        x += 1
+        return np.reciprocal(x, out=x)
+
+    activations = {'linear': linear, 'relu': relu, 'elu': elu, 'tanh': tanh, 'sigmoid': sigmoid}
+    if name not in activations:
+        raise ValueError('Unsupported activation %r.' % name)
+    return activations[name]
+
+
+def _windows(x, size, strides):
+    """
+    Views every (size[0], size[1]) window of a batch of images with shape (n, h, w, c), at the given strides, as an
+    array of shape (n, out_h, out_w, size[0], size[1], c) without copying.
+    """
+    n, h, w, c = x.shape
+    out_h = (h - size[0]) // strides[0] + 1
+    out_w = (w - size[1]) // strides[1] + 1
+    s = x.strides
+    return as_strided(x, shape=(n, out_h, out_w, size[0], size[1], c),
+                      strides=(s[0], s[1] * strides[0], s[2] * strides[1], s[1], s[2], s[3]))
+
+
+class _Layer(object):
+    """
+    A layer of the forward pass. `build` allocates the output buffers for an input shape, and `forward` writes the
+    output of a batch into them.
+    """
+    def set_weights(self, weights):
+        pass
+
+    def build(self, input_shape):
+        self.output_shape = input_shape
+
+    def forward(self, x):
+        return x
+
+
+class _Normalize(_Layer):
+    # The `Lambda` layer of `model.py`. Its function is serialized as bytecode, which cannot be run safely, so the
+    # normalisation it applies is fixed.
+    def build(self, input_shape):
+        self.output_shape = input_shape
+        self.out = np.empty(input_shape, dtype=np.float32)
+
+    def forward(self, x):
+        np.multiply(x, np.float32(1 / 255.), out=self.out)
+        self.out -= np.float32(0.5)
+        return self.out
+
+
+class _Conv2D(_Layer):
+    def __init__(self, filters, kernel_size, strides, padding, activation, use_bias):
+        self.filters = filters
+        self.kernel_size = kernel_size
+        self.strides = strides
+        self.padding = padding
+        self.activation = _activation(activation)
+        self.use_bias = use_bias
+
+    def set_weights(self, weights):
+        kernel = weights[0].astype(np.float32)
+        # Rows of the kernel matrix ordered as the (row, col, channel) of each im2col patch
+        self.kernel = np.ascontiguousarray(kernel.reshape(-1, self.filters))
+        self.bias = weights[1].astype(np.float32) if self.use_bias else None
+
+    def build(self, input_shape):
+        n, h, w, c = input_shape
+        kh, kw = self.kernel_size
+        if self.padding == 'same':
+            out_h, out_w = -(-h // self.strides[0]), -(-w // self.strides[1])
+            pad_h = max((out_h - 1) * self.strides[0] + kh - h, 0)
+            pad_w = max((out_w - 1) * self.strides[1] + kw - w, 0)
+            self.pad = (pad_h // 2, pad_w // 2)
+            self.padded = np.zeros((n, h + pad_h, w + pad_w, c), dtype=np.float32)
+        elif self.padding == 'valid':
+            out_h, out_w = (h - kh) // self.strides[0] + 1, (w - kw) // self.strides[1] + 1
+            self.padded = None
+        else:
+            raise ValueError('Unsupported padding %r.' % self.padding)
+
+        self.output_shape = (n, out_h, out_w, self.filters)
+        self.cols = np.empty((n * out_h * out_w, kh * kw * c), dtype=np.float32)
+        self.out = np.empty((n * out_h * out_w, self.filters), dtype=np.float32)
+        self.tmp = np.empty_like(self.out)
+
+    def forward(self, x):
+        if self.padded is not None:
+            top, left = self.pad
+            self.padded[:, top:top + x.shape[1], left:left + x.shape[2]] = x
+            x = self.padded
+
+        # im2col into the preallocated buffer, then a single GEMM over every patch of the batch
+        windows = _windows(x, self.kernel_size, self.strides)
+        np.copyto(self.cols.reshape(windows.shape), windows)
+        np.dot(self.cols, self.kernel, out=self.out)
+        if self.bias is not None:
+            self.out += self.bias
+        self.activation(self.out, self.tmp)
+        return self.out.reshape(self.output_shape)
+
+
+class _MaxPooling2D(_Layer):
+    def __init__(self, pool_size, strides, padding):
+        if padding != 'valid':
+            raise ValueError('Unsupported padding %r.' % padding)
+        self.pool_size = pool_size
+        self.strides = strides or pool_size
+
+    def build(self, input_shape):
+        n, h, w, c = input_shape
+        out_h = (h - self.pool_size[0]) // self.strides[0] + 1
+        out_w = (w - self.pool_size[1]) // self.strides[1] + 1
+        self.output_shape = (n, out_h, out_w, c)
+        self.out = np.empty(self.output_shape, dtype=np.float32)
+
+    def forward(self, x):
+        return np.max(_windows(x, self.pool_size, self.strides), axis=(3, 4), out=self.out)
+
+
+class _Flatten(_Layer):
+    def build(self, input_shape):
+        self.output_shape = (input_shape[0], int(np.prod(input_shape[1:])))
+
+    def forward(self, x):
+        return x.reshape(self.output_shape)
+
+
+class _Dense(_Layer):
+    def __init__(self, units, activation, use_bias):
+        self.units = units
+        self.activation = _activation(activation)
+        self.use_bias = use_bias
+
+    def set_weights(self, weights):
+        self.kernel = np.ascontiguousarray(weights[0], dtype=np.float32)
+        self.bias = weights[1].astype(np.float32) if self.use_bias else None
+
+    def build(self, input_shape):
+        self.output_shape = (input_shape[0], self.units)
+        self.out = np.empty(self.output_shape, dtype=np.float32)
+        self.tmp = np.empty_like(self.out)
+
+    def forward(self, x):
+        np.dot(x, self.kernel, out=self.out)
+        if self.bias is not None:
+            self.out += self.bias
+        return self.activation(self.out, self.tmp)
+
+
+class _Activation(_Layer):
+    def __init__(self, activation):
+        self.activation = _activation(activation)
+
+    def build(self, input_shape):
+        self.output_shape = input_shape
+        self.out = np.empty(input_shape, dtype=np.float32)
+        self.tmp = np.empty_like(self.out)
+
+    def forward(self, x):
+        np.copyto(self.out, x)
+        return self.activation(self.out, self.tmp)
+
+
+def _pair(value):
+    return tuple(value) if isinstance(value, (list, tuple)) else (value, value)
+
+
+def _layer_from_config(class_name, config):
+    """
+    Builds a layer from its Keras 1 or Keras 2 config. Only channels last image ordering is supported.
+    """
+    ordering = config.get('dim_ordering', config.get('data_format', 'tf'))
+    if ordering not in ('tf', 'channels_last', 'default'):
+        raise ValueError('Only channels last image ordering is supported, not %r.' % ordering)
+
+    if class_name == 'Lambda':
+        return _Normalize()
+    elif class_name in ('Convolution2D', 'Conv2D'):
+        if 'nb_filter' in config:
+            filters, kernel_size = config['nb_filter'], (config['nb_row'], config['nb_col'])
+            strides, padding, use_bias = config['subsample'], config['border_mode'], config.get('bias', True)
+        else:
+            filters, kernel_size = config['filters'], _pair(config['kernel_size'])
+            strides, padding, use_bias = config['strides'], config['padding'], config.get('use_bias', True)
+        return _Conv2D(filters, kernel_size, _pair(strides), padding, config['activation'], use_bias)
+    elif class_name == 'MaxPooling2D':
+        strides = config.get('strides')
+        return _MaxPooling2D(_pair(config['pool_size']), _pair(strides) if strides else None,
+                             config.get('border_mode', config.get('padding', 'valid')))
+    elif class_name == 'Flatten':
+        return _Flatten()
+    elif class_name == 'Dense':
+        units = config.get('output_dim', config.get('units'))
+        return _Dense(units, config['activation'], config.get('bias', config.get('use_bias', True)))
+    elif class_name == 'Activation':
+        return _Activation(config['activation'])
+    elif class_name == 'Dropout':
+        # Only active while training
+        return _Layer()
+    raise ValueError('Unsupported layer %r.' % class_name)
+
+
+class NumpyModel(object):
+    def __init__(self, layers, input_shape):
+        """
+        Forward pass of a Keras `Sequential` model in NumPy, without importing TensorFlow or Keras. Convolutions
+        are computed with im2col and a single matrix multiply, and every layer writes into buffers which are
+        allocated once per batch size.
+
+        :param layers: Layers of the model, in order
+        :param input_shape: Tuple with the (h, w, ch) of the input images
+        """
+        self.layers = layers
+        self.input_shape = tuple(input_shape)
+        self._batch_size = None
+
+    def _build(self, batch_size):
+        shape = (batch_size,) + self.input_shape
+        for layer in self.layers:
+            layer.build(shape)
+            shape = layer.output_shape
+        self._batch_size = batch_size
+
+    def predict(self, images, batch_size=None):
+        """
+        Same interface as Keras' `Model.predict`. The images are always run as a single batch.
+
+        :param images: Array of shape (n, h, w, ch)
+        :param batch_size: Ignored
+        :return: Array of shape (n, n_outputs)
+        """
+        if images.shape[0] != self._batch_size:
+            self._build(images.shape[0])
+
+        x = images
+        for layer in self.layers:
+            x = layer.forward(x)
+        # The output is a buffer which the next call overwrites
+        return np.array(x)
+
+
+def load_numpy_model(json_path, weights_path=None):
+    """
+    Loads a model saved with `model.to_json()` and `save_weights` into a `NumpyModel`.
+
+    :param json_path: Path to the model definition json
+    :param weights_path: Path to the h5 weights. Defaults to `json_path` with the extension replaced.
+    :return: The `NumpyModel`
+    """
+    if weights_path is None:
+        weights_path = json_path.replace('json', 'h5')
+
+    with open(json_path, 'r') as f:
+        model_config = json.load(f)
+    layer_configs = model_config['config']
+    # Keras 2 nests the layers of a `Sequential` model
+    if isinstance(layer_configs, dict):
+        layer_configs = layer_configs['layers']
+
+    first = layer_configs[0]['config']
+    input_shape = first.get('batch_input_shape', [None] + list(first.get('input_shape', [])))[1:]
+
+    layers = []
+    with h5py.File(weights_path, 'r') as f:
+        if 'model_weights' in f:
+            f = f['model_weights']
+        for layer_config in layer_configs:
+            layer = _layer_from_config(layer_config['class_name'], layer_config['config'])
+            name = layer_config['config']['name']
+            if name in f:
+                group = f[name]
+                weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+                if weight_names:
+                    layer.set_weights([group[n][()] for n in weight_names])
+            layers.append(layer)
+    return NumpyModel(layers, input_shape)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NumPy Steering Model')
+    parser.add_argument('model', type=str,
+                        help='Path to model definition json. Model weights should be on the same path.')
+    parser.add_argument('--samples', type=int, default=64, help='Number of random frames to compare on.')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='Maximum absolute difference allowed.')
+    args = parser.parse_args()
+
+    numpy_model = load_numpy_model(args.model)
+
+    from keras.models import model_from_json
+    with open(args.model, 'r') as jfile:
+        keras_model = model_from_json(jfile.read())
+    keras_model.load_weights(args.model.replace('json', 'h5'))
+
+    frames = np.random.randint(0, 256, size=(args.samples,) + numpy_model.input_shape).astype(np.float32)
+    diffs = [abs(float(numpy_model.predict(frames[i:i + 1])) - float(keras_model.predict(frames[i:i + 1])))
+             for i in range(args.samples)]
+
+    print('Max absolute difference from Keras over %d frames: %g' % (args.samples, max(diffs)))
+    if max(diffs) > args.tolerance:
+        raise SystemExit('The NumPy model does not match Keras within %g.' % args.tolerance)
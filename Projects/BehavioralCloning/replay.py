@@ -0,0 +1,143 @@
+import re
+import json
+import time
+import base64
+import calendar
+import platform
+import resource
+import argparse
+import cv2
+import numpy as np
+import pandas as pd
+
+from utils import load_data
+from server import SteeringServer, load_model
+
+
+class ReplayClient(object):
+    def __init__(self, data_dir, file='driving_log.csv', limit=None):
+        """
+        In-process stand-in for the simulator's socketio client. Holds the center frames of a recorded run as the
+        base64 encoded telemetry payloads the simulator sends, and records the commands sent back to it.
+
+        The frames are read and encoded up front, so the replay only measures the serving side.
+
+        :param data_dir: Directory containing the driving log
+        :param file: The name of the driving log
+        :param limit: Optional number of frames to replay from the start of the run
+        """
+        data = load_data(data_dir, file)
+        log = pd.read_csv(data_dir + file, header=None, usecols=[4, 6], names=['Throttle', 'Speed'])
+
+        self.paths = data['center'][:limit]
+        self.payloads = []
+        for path, angle, throttle, speed in zip(self.paths, data['angles'], log['Throttle'].values,
+                                                log['Speed'].values):
+            with open(path, 'rb') as f:
+                image = base64.b64encode(f.read()).decode('ascii')
+            self.payloads.append({'steering_angle': str(angle), 'throttle': str(throttle),
+                                  'speed': str(speed), 'image': image})
+
+        self.commands = []
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def emit(self, steering_angle, throttle):
+        """
+        Receives a command, in place of `drive.send_control`.
+        """
+        self.commands.append((time.time(), steering_angle, throttle))
+
+
+def frame_times(paths):
+    """
+    Seconds from the first frame at which each frame was recorded, parsed from the timestamps the simulator puts in
+    the image names, e.g. `center_2016_12_01_13_30_48_287.jpg`.
+    """
+    times = []
+    for path in paths:
+        match = re.search(r'(\d{4})_(\d\d)_(\d\d)_(\d\d)_(\d\d)_(\d\d)_(\d{3})', path)
+        if match is None:
+            raise ValueError('No timestamp in image name %s.' % path)
+        fields = [int(x) for x in match.groups()]
+        times.append(calendar.timegm(fields[:6] + [0, 0, 0]) + fields[6] / 1000.)
+    return np.array(times) - times[0]
+
+
+def replay(server, client, schedule=None):
+    """
+    Plays every payload of `client` into `server.submit`, the path of the telemetry handler in `drive.py`, and
+    waits until every message has been served or dropped.
+
+    :param server: A started `SteeringServer` which sends its commands to `client.emit`
+    :param client: The `ReplayClient`
+    :param schedule: Optional seconds from the start at which to send each payload. Sent as fast as possible if
+        not given.
+    :return: Tuple containing (seconds to send every payload, seconds until every message was handled)
+    """
+    start = time.time()
+    for i, payload in enumerate(client.payloads):
+        if schedule is not None:
+            wait = start + schedule[i] - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        server.submit(payload)
+    sent = time.time() - start
+
+    counts = server.counts
+    while counts['served'] + counts['replaced'] + counts['stale'] < counts['received']:
+        time.sleep(0.001)
+    return sent, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Telemetry Replay')
+    parser.add_argument('model', type=str,
+                        help='Path to model definition json. Model weights should be on the same path.')
+    parser.add_argument('data_dir', type=str, help='Directory containing the driving_log.csv to replay.')
+    parser.add_argument('--engine', choices=['keras', 'numpy'], default='keras', help='Engine to run the model.')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Messages per second to send. 0 sends as fast as possible.')
+    parser.add_argument('--realtime', action='store_true',
+                        help='Send each frame at the time it was recorded, instead of at a fixed rate.')
+    parser.add_argument('--limit', type=int, default=None, help='Only replay this many frames.')
+    parser.add_argument('--max-latency', type=float, default=0.1,
+                        help='Drop frames which are older than this many seconds before or after the prediction.')
+    parser.add_argument('--out', default=None, help='Path to write the JSON report to. Printed if not given.')
+    args = parser.parse_args()
+
+    client = ReplayClient(args.data_dir, limit=args.limit)
+    if args.realtime:
+        schedule = frame_times(client.paths)
+    elif args.rate > 0:
+        schedule = np.arange(len(client)) / args.rate
+    else:
+        schedule = None
+
+    # Keep the timings of every message, so the report covers the whole run
+    server = SteeringServer(load_model(args.model, args.engine), client.emit, max_latency=args.max_latency,
+                            window=None)
+    server.warmup()
+    server.start()
+    sent, duration = replay(server, client, schedule)
+    server.stop()
+
+    report = server.stats()
+    report['dropped'] = report['replaced'] + report['stale']
+    report['duration_s'] = duration
+    report['offered_hz'] = len(client) / sent
+    report['achieved_hz'] = report['served'] / duration
+    angles = np.array([angle for _, angle, _ in client.commands] or [0.])
+    report['steering'] = {'mean': float(np.mean(angles)), 'std': float(np.std(angles))}
+    report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report['platform'] = {'python': platform.python_version(), 'machine': platform.machine(),
+                          'cv2': cv2.__version__, 'numpy': np.__version__}
+    report['settings'] = {'model': args.model, 'engine': args.engine, 'frames': len(client),
+                          'rate': 'realtime' if args.realtime else args.rate, 'max_latency': args.max_latency}
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
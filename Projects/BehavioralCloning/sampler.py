@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class AliasTable(object):
+    def __init__(self, weights):
+        """
+        Walker's alias table over a discrete distribution. Built once in O(n), after which every draw takes O(1)
+        regardless of how skewed the weights are.
+
+        :param weights: Non-negative weight of each item. Does not need to be normalized.
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        assert weights.ndim == 1 and np.all(weights >= 0) and np.sum(weights) > 0, 'Invalid weights.'
+
+        n = weights.shape[0]
+        scaled = weights * n / np.sum(weights)
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+
+        # Vose's method: pair every under-full column with an over-full one
+        small = list(np.nonzero(scaled < 1)[0])
+        large = list(np.nonzero(scaled >= 1)[0])
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def __len__(self):
+        return self.prob.shape[0]
+
+    def draw(self, size):
+        """
+        Draws `size` item indices with replacement, with probability proportional to their weights.
+        """
+        columns = np.random.randint(0, len(self), size=size)
+        keep = np.random.uniform(0.0, 1.0, size=size) < self.prob[columns]
+        return np.where(keep, columns, self.alias[columns])
+
+
+def angle_weights(angles, n_bins=41, power=1.0, reference=None):
+    """
+    Sampling weights which rebalance a dataset over its steering angle histogram. Each sample is weighted by the
+    number of samples in its histogram bin to the power of `-power`, so 0 keeps the natural distribution, and 1
+    draws every bin equally often.
+
+    :param angles: Steering angle of each sample, normalized between [-1, 1]
+    :param n_bins: Number of histogram bins over [-1, 1]
+    :param power: Strength of the rebalancing
+    :param reference: Optional steering angles whose histogram is used instead of that of `angles`, E.G. to weight
+        a validation set the same way as the training set. Empty bins count as one sample.
+    :return: Array with the weight of each sample
+    """
+    def to_bins(values):
+        return np.clip(((np.asarray(values) + 1) / 2 * n_bins).astype(np.int64), 0, n_bins - 1)
+
+    bins = to_bins(angles)
+    counts = np.bincount(bins if reference is None else to_bins(reference), minlength=n_bins)
+    return np.maximum(counts[bins], 1).astype(np.float64) ** -power
@@ -0,0 +1,195 @@
+import base64
+import threading
+import time
+from io import BytesIO
+from collections import deque
+
+import numpy as np
+import cv2
+from PIL import Image
+
+from utils import process_image
+
+
+# Stages of handling a telemetry message, in order
+STAGES = ['decode', 'preprocess', 'predict', 'emit']
+
+
+def load_model(path, engine='keras'):
+    """
+    Loads the steering model to serve.
+
+    :param path: Path to model definition json. Model weights should be on the same path.
+    :param engine: 'keras', or 'numpy' for the forward pass in `numpy_model.py`
+    :return: Model with a Keras style `predict(images, batch_size)`
+    """
+    if engine == 'numpy':
+        from numpy_model import load_numpy_model
+        return load_numpy_model(path)
+
+    # Imported here, so the NumPy engine never loads TensorFlow
+    from keras.models import model_from_json
+
+    # Fix error with Keras and TensorFlow
+    import tensorflow as tf
+    tf.python.control_flow_ops = tf
+
+    with open(path, 'r') as jfile:
+        # NOTE: if you saved the file by calling json.dump(model.to_json(), ...)
+        # then you will have to call:
+        #
+        #   model = model_from_json(json.loads(jfile.read()))\
+        #
+        # instead.
+        model = model_from_json(jfile.read())
+
+    model.compile("adam", "mse")
+    weights_file = path.replace('json', 'h5')
+    model.load_weights(weights_file)
+    return model
+
+
+class SteeringServer(object):
+    def __init__(self, model, send, max_latency=0.1, target_speed=30, offload=None, window=1000):
+        """
+        Serves steering commands for telemetry messages on a dedicated worker, so decoding and inference never
+        block the socket that receives the messages.
+
+        Messages are handed over through a single slot where the latest frame wins: a message which arrives while
+        the worker is busy replaces the waiting one, which is dropped rather than queued. A message which is older
+        than `max_latency` when the worker takes it, or once its steering angle has been predicted, is dropped as
+        stale, so every command that is sent was computed from a frame at most `max_latency` seconds old.
+
+        :param model: Model with a Keras style `predict(images, batch_size)`
+        :param send: Function called with (steering_angle, throttle) for each served message
+        :param max_latency: Maximum age in seconds of a message when its command is sent
+        :param target_speed: Speed to hold with the throttle
+        :param offload: Optional function with the signature of `eventlet.tpool.execute` to run the decoding and
+            inference on, when the worker is a green thread.
+        :param window: Number of most recent served messages the timings in `stats` are computed over, so a long
+            session holds a bounded history. None keeps every message.
+        """
+        self.model = model
+        self.send = send
+        self.max_latency = max_latency
+        self.target_speed = target_speed
+        self.offload = offload
+
+        # Stable input buffer, reused by every prediction
+        self._input = np.zeros((1, 64, 64, 3), dtype=np.float32)
+
+        self._slot = None
+        self._cond = threading.Condition()
+        self._running = False
+        self._worker = None
+
+        self.counts = {'received': 0, 'served': 0, 'replaced': 0, 'stale': 0}
+        self.timings = {stage: deque(maxlen=window) for stage in STAGES + ['latency']}
+
+    def warmup(self, n=3):
+        """
+        Runs a few predictions on the input buffer, so the first real frame does not pay for any lazy
+        initialisation of the model.
+        """
+        for _ in range(n):
+            self.model.predict(self._input, batch_size=1)
+
+    def start(self):
+        self._running = True
+        self._worker = threading.Thread(target=self._serve, daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._worker.join()
+
+    def submit(self, data):
+        """
+        Hands a telemetry message to the worker and returns immediately.
+
+        :param data: Telemetry message with keys ['steering_angle', 'throttle', 'speed', 'image']
+        """
+        with self._cond:
+            self.counts['received'] += 1
+            if self._slot is not None:
+                self.counts['replaced'] += 1
+            self._slot = (time.time(), data)
+            self._cond.notify()
+
+    def stats(self):
+        """
+        Message counts along with the mean, median, 95th percentile and maximum milliseconds spent in each stage,
+        and from receiving each served message to sending its command, `latency`, over the last `window` served
+        messages.
+        """
+        summary = dict(self.counts)
+        for stage, times in self.timings.items():
+            times = 1000 * np.array(times or [0.])
+            summary[stage + '_ms'] = {'mean': float(np.mean(times)), 'p50': float(np.percentile(times, 50)),
+                                      'p95': float(np.percentile(times, 95)), 'max': float(np.max(times))}
+        return summary
+
+    def _serve(self):
+        """
+        Takes the latest message from the slot until stopped, and serves it unless it is stale before or after the
+        prediction.
+        """
+        while True:
+            with self._cond:
+                while self._slot is None and self._running:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                received, data = self._slot
+                self._slot = None
+
+            if time.time() - received > self.max_latency:
+                self.counts['stale'] += 1
+                continue
+
+            if self.offload is not None:
+                steering_angle, timings = self.offload(self._predict, data['image'])
+            else:
+                steering_angle, timings = self._predict(data['image'])
+
+            # A slow prediction can make the frame too old to act on
+            if time.time() - received > self.max_latency:
+                self.counts['stale'] += 1
+                continue
+
+            throttle = float(data['throttle'])
+            if float(data['speed']) < self.target_speed: throttle += 0.1
+            else: throttle -= 0.05
+
+            t = time.time()
+            self.send(steering_angle, throttle)
+            timings['emit'] = time.time() - t
+
+            timings['latency'] = time.time() - received
+            for stage, seconds in timings.items():
+                self.timings[stage].append(seconds)
+            self.counts['served'] += 1
+
+    def _predict(self, image_string):
+        """
+        Decodes and preprocesses a base64 encoded frame into the input buffer and predicts its steering angle.
+
+        :return: Tuple containing (steering_angle, timings), with the seconds spent in each stage.
+        """
+        timings = {}
+
+        t = time.time()
+        image = np.asarray(Image.open(BytesIO(base64.b64decode(image_string))))
+        timings['decode'] = time.time() - t
+
+        t = time.time()
+        processed = process_image(image)
+        self._input[0] = cv2.cvtColor(processed, cv2.COLOR_BGR2HSV)
+        timings['preprocess'] = time.time() - t
+
+        t = time.time()
+        steering_angle = float(self.model.predict(self._input, batch_size=1))
+        timings['predict'] = time.time() - t
+        return steering_angle, timings
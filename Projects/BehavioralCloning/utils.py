@@ -3,8 +3,19 @@ import cv2
 import pandas as pd
 
 from sklearn.model_selection import train_test_split
+from functools import lru_cache
 from sklearn.utils import shuffle
 from decorators import n_images
+from sampler import AliasTable
+
+
+# Rows of the camera frames kept by `process_image`, and the size of the frames in pixels
+CROP = (50, 135)
+FRAME_HEIGHT, FRAME_WIDTH = 160, 320
+
+# Rows of the camera frames stored by a `FrameCache`. The margin around `CROP` covers every row the shifts (7 px),
+# rotations (1 degree) and scaling (2%) of `augment_batch` can move into the crop, so they never pull in black rows.
+CACHE_ROWS = (CROP[0] - 16, CROP[1] + 16)
 
 
 def load_data(path, file):
@@ -22,11 +33,17 @@ def load_data(path, file):
     """
     df = pd.read_csv(path + file, names=['CenterImage', 'LeftImage', 'RightImage', 'SteeringAngle',
                                          'Throttle', 'Break', 'Speed'])
+
+    def clean(column):
+        # Clean the paths of every row at once with pandas' vectorised string methods
+        paths = df[column].astype(str).str.replace(' ', '', regex=False).str.replace('\\', '/', regex=False)
+        return (path + paths).values.astype(str)
+
     data = {
-        'angles': df['SteeringAngle'].astype('float32').as_matrix(),
-        'center': np.array([path + str(im).replace(' ', '').replace('\\', '/') for im in df['CenterImage'].as_matrix()]),
-        'right': np.array([path + str(im).replace(' ', '').replace('\\', '/') for im in df['RightImage'].as_matrix()]),
-        'left': np.array([path + str(im).replace(' ', '').replace('\\', '/') for im in df['LeftImage'].as_matrix()])
+        'angles': df['SteeringAngle'].values.astype('float32'),
+        'center': clean('CenterImage'),
+        'right': clean('RightImage'),
+        'left': clean('LeftImage')
       }
     return data
 
@@ -79,7 +96,9 @@ def transform_ang(angle, camera, recovery_dist=15, camera_shift=1.5, angle_range
     Input angle should be normalized between [-1, 1] with the `angle_range` representing
     the full scale of angles.
 
-    :param angle: The steering angle of the center camera.
+    Also accepts an array of angles, which are all transformed at once.
+
+    :param angle: The steering angle of the center camera, or an array of them.
     :param camera: The camera to transform the perspective to. Either 'left' or 'right'.
     :param recovery_dist: The estimated distance in meters for the car to recover to the center
         of the lane at the current steering angle.
@@ -89,7 +108,7 @@ def transform_ang(angle, camera, recovery_dist=15, camera_shift=1.5, angle_range
     :return: Corrected steering angle, normalized between [-1, 1].
     """
     sign = -np.sign(angle)
-    rad = np.deg2rad(abs(angle_range*angle))
+    rad = np.deg2rad(np.abs(angle_range*angle))
     tan = np.tan(np.pi/2 - rad)
 
     if camera == 'right':
@@ -117,6 +136,9 @@ def concat_all_cameras(data, angle_shift, condition_lambda, keep_percent, drop_c
 
     Note that the lambda should return True for the values you would like to filter.
 
+    If `data` also contains ['left_angles', 'right_angles'], E.G. from `log_index.run_data`, those are used as
+    the transformed angles of the side cameras instead of being computed.
+
     :param data: Dictionary containing ['angles', 'center', 'left', 'right']
     :param angle_shift: The amount to shift the left/right camera images by.
     :param condition_lambda: Condition by which to keep data.
@@ -125,19 +147,21 @@ def concat_all_cameras(data, angle_shift, condition_lambda, keep_percent, drop_c
     :return: Tuple containing (paths, angles)
     """
     # Remove n% of the frames where the steering angle is close to zero
-    ims, angs = keep_n_percent_of_data_where(
-        data=np.array([data['center'], data['left'], data['right']]).T,
+    rows, angs = keep_n_percent_of_data_where(
+        data=np.arange(data['angles'].shape[0]),
         values=data['angles'],
         condition_lambda=condition_lambda,
         percent=keep_percent
       )
 
-    center = np.array([im for im in ims[..., 0]])
-    left = np.array([im for im in ims[..., 1]])
-    right = np.array([im for im in ims[..., 2]])
+    center, left, right = data['center'][rows], data['left'][rows], data['right'][rows]
 
-    transformed_left_angs = np.array([transform_ang(ang, 'left') for ang in angs])
-    transformed_right_angs = np.array([transform_ang(ang, 'right') for ang in angs])
+    if 'left_angles' in data and 'right_angles' in data:
+        transformed_left_angs = data['left_angles'][rows]
+        transformed_right_angs = data['right_angles'][rows]
+    else:
+        transformed_left_angs = transform_ang(angs, 'left')
+        transformed_right_angs = transform_ang(angs, 'right')
 
     if drop_camera == 'left':
         filtered_paths = np.concatenate((center, right), axis=0)
@@ -169,11 +193,12 @@ def split_data(features, labels, test_size=0.2, shuffle_return=True):
     return train_test_split(features, labels, test_size=test_size)
 
 
-def process_image(im):
+def process_image(im, cropped=False):
     """
     Crop image, convert to HSV, and resize.
 
     :param im: Image to normalize
+    :param cropped: If True, `im` only holds the rows in `CACHE_ROWS`, E.G. a frame from a `FrameCache`.
     :return: Normalized image with shape (h, w, ch)
 
     :type im: np.ndarray with shape (h, w, 3)
@@ -181,7 +206,11 @@ def process_image(im):
     """
     assert im.ndim == 3 and im.shape[2] == 3, 'Must be a BGR image with shape (h, w, 3)'
 
-    im = im[50:135, :]
+    if cropped:
+        top, crop_h = cached_crop(im.shape[1])
+        im = im[top:top + crop_h, :]
+    else:
+        im = im[CROP[0]:CROP[1], :]
     im = cv2.resize(im, (64, 64))
 
     if im.ndim == 2:
@@ -189,6 +218,26 @@ def process_image(im):
     return im
 
 
+def process_cropped(im):
+    """
+    Normalizes a frame which only holds the rows in `CACHE_ROWS`. Use as the `im_normalizer` for frames from a
+    `FrameCache`.
+    """
+    return process_image(im, cropped=True)
+
+
+def cached_crop(w):
+    """
+    Position of the rows in `CROP` within a frame from a `FrameCache`, which holds the rows in `CACHE_ROWS` resized
+    by the same factor as its width.
+
+    :param w: Width of the cached frames
+    :return: Tuple with the (first row, number of rows) of the crop
+    """
+    pixel_scale = w / FRAME_WIDTH
+    return int(round((CROP[0] - CACHE_ROWS[0])*pixel_scale)), int(round((CROP[1] - CROP[0])*pixel_scale))
+
+
 @n_images  # Decorator to generalize single image method to multiple images
 def flip_image(image, angle):
     """
@@ -250,6 +299,9 @@ def augment_image(image, value, prob, im_normalizer=process_image):
     and slightly rotates, shifts and scales the image. These augmentations are meant to make the
     model more robust to conditions different to those in the training set.
 
+    The shifts are drawn in pixels of the full 320 pixel wide frame, and are scaled to the width of
+    `image`, so cropped or downscaled frames are shifted by the same proportion.
+
     :param image: The image to augment
     :param value: The steering angle associated with the image
     :param prob: The probability of augmenting the image
@@ -284,24 +336,46 @@ def augment_image(image, value, prob, im_normalizer=process_image):
     if color_channels == 1:
         image[..., 0] = add_random_shadow(image[..., 0])
 
-    # Rotation/Scaling matrix
+    # Rotation/Scaling and shifts
     rotation, scale = 1, 0.02
-    M_rot = cv2.getRotationMatrix2D(
-        (h//2, w//2),
-        np.random.uniform(-rotation, rotation),
-        np.random.uniform(1.0 - scale, 1.0 + scale)
-      )
+    angle = np.random.uniform(-rotation, rotation)
+    zoom = np.random.uniform(1.0 - scale, 1.0 + scale)
+    x_shift = np.random.randint(-40, 41)
+    y_shift = np.random.randint(-7, 8)
+
+    augmented = warp_image(image, angle, zoom, x_shift, y_shift)
+
+    # Shift steering angle in accordance with pixel shift
+    value += x_shift*4e-3
+
+    augmented = im_normalizer(augmented)
+    return augmented, value
+
+
+def warp_image(image, angle, zoom, x_shift, y_shift):
+    """
+    Shifts an image, then rotates and scales it about the point (h//2, w//2). The geometric step of `augment_image`.
+
+    :param image: Image with shape (h, w, ch)
+    :param angle: Rotation in degrees
+    :param zoom: Scale
+    :param x_shift: Horizontal shift in pixels of the full 320 pixel wide frame
+    :param y_shift: Vertical shift in pixels of the full 320 pixel wide frame
+    :return: The warped image, with the same shape
+    """
+    h, w = image.shape[:2]
+
+    # Rotation/Scaling matrix
+    M_rot = cv2.getRotationMatrix2D((h//2, w//2), angle, zoom)
 
     # Shifts/Affine transforms
     src = np.array([[0,0], [w,0], [w,h]]).astype(np.float32)
 
-    x_shift = np.random.randint(-40, 41)
-    y_shift = np.random.randint(-7, 8)
-
+    pixel_scale = w / FRAME_WIDTH
     dst = np.array([
-        [0 + x_shift, 0 + y_shift],
-        [w + x_shift, 0 + y_shift],
-        [w + x_shift, h + y_shift]
+        [0 + x_shift*pixel_scale, 0 + y_shift*pixel_scale],
+        [w + x_shift*pixel_scale, 0 + y_shift*pixel_scale],
+        [w + x_shift*pixel_scale, h + y_shift*pixel_scale]
       ]).astype(np.float32)
 
     M_affine = cv2.getAffineTransform(src, dst)
@@ -310,33 +384,272 @@ def augment_image(image, value, prob, im_normalizer=process_image):
     augmented = cv2.warpAffine(image, M_affine, (w,h))
     augmented = cv2.warpAffine(augmented, M_rot, (w,h))
 
-    # Shift steering angle in accordance with pixel shift
-    value += x_shift*4e-3
-
     # Ensure there is a color channel
     if augmented.ndim == 2:
         augmented = np.expand_dims(augmented, -1)
 
-    augmented = augmented.astype(np.uint8)
-    augmented = im_normalizer(augmented)
-    return augmented, value
+    return augmented.astype(np.uint8)
+
+
+@lru_cache(maxsize=4)
+def _shadow_grid(h, w):
+    """
+    Row and column coordinates of the pixels, with shapes (1, h, 1) and (1, 1, w) so they broadcast against each
+    other and over a batch. Cached, as every batch has the same image shape.
+    """
+    rows = np.arange(h, dtype=np.float32).reshape(1, h, 1)
+    cols = np.arange(w, dtype=np.float32).reshape(1, 1, w)
+    rows.flags.writeable = False
+    cols.flags.writeable = False
+    return rows, cols
+
 
+def batch_shadow_factors(n, h, w):
+    """
+    Draws the random shadows and brightness changes of `add_random_shadow` for a whole batch at once, from the
+    same distributions.
 
-def val_augmentor(ims, vals):
+    :param n: Number of images
+    :param h: Height of the images
+    :param w: Width of the images
+    :return: Array of shape (n, h, w) to multiply the brightness channel of each image by.
+    """
+    top_y, bot_y = np.random.randint(2*w//10, 8*w//10, size=(2, n, 1, 1)).astype(np.float32)
+    left_x, right_x = np.random.randint(2*h//10, 8*h//10, size=(2, n, 1, 1)).astype(np.float32)
+    vertical = np.random.randint(0, 2, size=n).astype(np.bool_)
+    side = np.random.randint(0, 2, size=(n, 1, 1)).astype(np.bool_)
+    darkness = np.random.uniform(0.35, 0.95, size=(n, 1, 1)).astype(np.float32)
+    brightness = np.random.uniform(0.4, 1.1, size=(n, 1, 1)).astype(np.float32)
+
+    # Each shadow is the half-plane on one side of a random vertical or horizontal line. Both sides of each test
+    # only vary along rows or columns, so only the comparison is as large as the batch, and each image only
+    # computes the test for its own kind of line.
+    rows, cols = _shadow_grid(h, w)
+    shadow = np.empty((n, h, w), dtype=np.bool_)
+    v, hz = vertical, ~vertical
+    shadow[v] = rows*(bot_y[v]-top_y[v]) >= h*(cols-top_y[v])
+    shadow[hz] = (rows-left_x[hz])*(0-w) >= (right_x[hz]-left_x[hz])*(cols-w)
+
+    np.equal(shadow, side, out=shadow)
+    return np.where(shadow, darkness*brightness, brightness)
+
+
+def augment_batch(images, values, prob, cropped=False, out_size=(64, 64)):
+    """
+    Augments a batch of images and steering angles with the same distributions as `augment_image`, drawing every
+    random parameter for the batch at once.
+
+    The shadows and brightness changes of the augmented images are applied to their brightness channels with one
+    broadcast multiply. The flip, shift, rotation/scaling, crop and resize of each image are then composed into a
+    single 2x3 matrix, so each image is resampled once, straight into a preallocated output array, instead of
+    being warped twice at full resolution and then resized by `process_image`.
+
+    :param images: Batch of HSV images with shape (n, h, w, ch)
+    :param values: The steering angles associated with the images
+    :param prob: The probability of augmenting each image
+    :param cropped: If True, the images only hold the rows in `CACHE_ROWS`, E.G. frames from a `FrameCache`.
+    :param out_size: Tuple with the (width, height) of the output images
+    :return: Tuple with (augmented_images, augmented_values)
+    """
+    assert images.ndim == 4, 'Images must have dimensions (n, h, w, ch)'
+    assert images.shape[0] == values.shape[0], 'Different # of data and values.'
+
+    n, h, w, color_channels = images.shape
+    values = np.asarray(values, dtype=np.float64)
+
+    # Flip the image and angle half the time
+    flip = np.random.uniform(0.0, 1.0, size=n) < 0.5
+    values = np.where(flip, -values, values)
+
+    augment = np.random.uniform(0.0, 1.0, size=n) <= prob
+    n_aug = int(np.sum(augment))
+
+    # Random shadow simulation on the brightness channel of the augmented images. The shadows are symmetric, so
+    # they are drawn on the unflipped images.
+    if n_aug > 0:
+        images = images.copy()
+        channel = 2 if color_channels == 3 else 0
+        brightness = images[augment, ..., channel] * batch_shadow_factors(n_aug, h, w)
+        images[augment, ..., channel] = np.clip(brightness, 0, 255).astype(np.uint8)
+
+    # Rotation/scaling and shift parameters, which are the identity for the images which are not augmented
+    rotation, scale = 1, 0.02
+    angles, zooms = np.zeros(n), np.ones(n)
+    x_shifts, y_shifts = np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64)
+    angles[augment] = np.random.uniform(-rotation, rotation, size=n_aug)
+    zooms[augment] = np.random.uniform(1.0 - scale, 1.0 + scale, size=n_aug)
+    x_shifts[augment] = np.random.randint(-40, 41, size=n_aug)
+    y_shifts[augment] = np.random.randint(-7, 8, size=n_aug)
+
+    # Shift steering angle in accordance with pixel shift
+    values += x_shifts*4e-3
+
+    return warp_batch(images, flip, angles, zooms, x_shifts, y_shifts, cropped, out_size), values
+
+
+def warp_batch(images, flip, angles, zooms, x_shifts, y_shifts, cropped=False, out_size=(64, 64)):
+    """
+    Mirrors, warps, crops and resizes each image of a batch with a single `cv2.warpAffine`. The geometric step of
+    `augment_batch`, which matches `warp_image` followed by `process_image`.
+
+    :param images: Batch of images with shape (n, h, w, ch)
+    :param flip: Boolean array, whether to mirror each image
+    :param angles: Rotation of each image in degrees
+    :param zooms: Scale of each image
+    :param x_shifts: Horizontal shift of each image in pixels of the full 320 pixel wide frame
+    :param y_shifts: Vertical shift of each image in pixels of the full 320 pixel wide frame
+    :param cropped: If True, the images only hold the rows in `CACHE_ROWS`, E.G. frames from a `FrameCache`.
+    :param out_size: Tuple with the (width, height) of the output images
+    :return: Array of shape (n, out_size[1], out_size[0], ch)
+    """
+    n, h, w, color_channels = images.shape
+    matrices = augmentation_matrices(h, w, flip, angles, zooms, x_shifts*(w / FRAME_WIDTH),
+                                     y_shifts*(w / FRAME_WIDTH), cropped, out_size)
+
+    output = np.empty((n, out_size[1], out_size[0], color_channels), dtype=np.uint8)
+    for i in range(n):
+        output[i] = cv2.warpAffine(images[i], matrices[i], out_size).reshape(output.shape[1:])
+    return output
+
+
+def augmentation_matrices(h, w, flip, angles, zooms, x_shifts, y_shifts, cropped=False, out_size=(64, 64)):
+    """
+    Composes the augmentations and normalization of `augment_image` into one affine matrix per image: a mirror
+    from left to right, a shift, a rotation/scaling about the same center as `augment_image`, the crop of
+    `process_image`, and the resize to `out_size`.
+
+    The shift, rotation and crop are applied in the coordinates of the full camera frame, so frames from a
+    `FrameCache` are transformed exactly as the full frames they were cut from.
+
+    :param h: Height of the source images
+    :param w: Width of the source images
+    :param flip: Boolean array, whether to mirror each image
+    :param angles: Rotation of each image in degrees
+    :param zooms: Scale of each image
+    :param x_shifts: Horizontal shift of each image in source pixels
+    :param y_shifts: Vertical shift of each image in source pixels
+    :param cropped: If True, the source images only hold the rows in `CACHE_ROWS`, resized by `w / FRAME_WIDTH`.
+    :param out_size: Tuple with the (width, height) of the output images
+    :return: Array of shape (n, 2, 3) to pass to `cv2.warpAffine`
+    """
+    n = flip.shape[0]
+
+    def stack(*entries):
+        """
+        Builds n 3x3 matrices from their 9 entries in row-major order, each a scalar or an array of length n.
+        """
+        entries = [np.broadcast_to(np.asarray(e, dtype=np.float64), (n,)) for e in entries]
+        return np.stack(entries, axis=-1).reshape(n, 3, 3)
+
+    # Rows of cached frames start at `CACHE_ROWS[0]` of the full frame, at the resolution of the cached frames
+    if cropped:
+        pixel_scale = w / FRAME_WIDTH
+        offset, frame_h = CACHE_ROWS[0]*pixel_scale, int(FRAME_HEIGHT*pixel_scale)
+        top, crop_h = cached_crop(w)
+        top += offset
+    else:
+        offset, frame_h = 0, h
+        top, crop_h = CROP[0], CROP[1] - CROP[0]
+
+    mirror = stack(np.where(flip, -1, 1), 0, np.where(flip, w - 1, 0),
+                   0, 1, 0,
+                   0, 0, 1)
+    # Shift, after moving the source rows to their rows in the full frame
+    shift = stack(1, 0, x_shifts,
+                  0, 1, y_shifts + offset,
+                  0, 0, 1)
+
+    # Same as `cv2.getRotationMatrix2D((h//2, w//2), angle, zoom)` on the full frame
+    cx, cy = frame_h//2, w//2
+    alpha = zooms*np.cos(np.deg2rad(angles))
+    beta = zooms*np.sin(np.deg2rad(angles))
+    rotate = stack(alpha, beta, (1 - alpha)*cx - beta*cy,
+                   -beta, alpha, beta*cx + (1 - alpha)*cy,
+                   0, 0, 1)
+
+    # Crop, then resize with the same pixel center alignment as `cv2.resize`
+    sx, sy = out_size[0] / w, out_size[1] / crop_h
+    resize = np.array([[sx, 0, 0.5*sx - 0.5],
+                       [0, sy, sy*(0.5 - top) - 0.5],
+                       [0, 0, 1]])
+
+    return np.matmul(resize, np.matmul(rotate, np.matmul(shift, mirror)))[:, :2, :]
+
+
+def val_augmentor(ims, vals, im_normalizer=process_image):
     """
     Normalizes images/vals into first set, flips and concats into second set, concats both sets, and returns.
 
     :param ims: Images to normalize/flip
     :param vals: Angles to normalize/flip
+    :param im_normalizer: Function to normalize the images
     :return: (normalized/flipped images, normalized/flipped angles)
     """
-    normalized = np.array([process_image(im) for im in ims])
-    flipped_ims, flipped_vals = flip_image(normalized, vals)
-    return np.concatenate((normalized, flipped_ims), axis=0), \
-           np.concatenate((vals, flipped_vals), axis=0)
+    n = ims.shape[0]
+    output = None
+    for i, im in enumerate(ims):
+        normalized = im_normalizer(im)
+        if output is None:
+            output = np.empty((2*n,) + normalized.shape, dtype=np.uint8)
+        output[i] = normalized
 
+    # The second half is the first half mirrored from left to right
+    output[n:] = output[:n, :, ::-1]
+    return output, np.concatenate((vals, -vals), axis=0)
 
-def batch_generator(ims, angs, batch_size, augmentor, path, kwargs={}, validation=False):
+
+def validation_set(ims, angs, path, cache=None, im_normalizer=process_image, chunk_size=1024):
+    """
+    Materialises the output of `val_augmentor` over a whole dataset once: every image normalized, followed by its
+    mirrored copy, in one contiguous array. As the validation data never changes, it can be passed to Keras as
+    arrays instead of being read and processed again on every epoch.
+
+    :param ims: The filepaths to the images
+    :param angs: The steering angles corresponding to the image paths
+    :param path: A filepath which will be appended to the beginning of each image path
+    :param cache: Optional `FrameCache` holding every image in `ims`
+    :param im_normalizer: Function to normalize the images. Must be `process_cropped` with a `cache`.
+    :param chunk_size: Number of images to load at a time
+    :return: Tuple with (images, angles), with shapes (2N, 64, 64, 3) and (2N,)
+    """
+    n_obs = ims.shape[0]
+    assert n_obs == angs.shape[0], 'Different # of data and labels.'
+
+    if cache is not None:
+        ims = cache.rows([path + im for im in ims])
+
+    images = None
+    for start in range(0, n_obs, chunk_size):
+        for i, im in enumerate(load_batch(ims[start:start + chunk_size], path, cache)):
+            normalized = im_normalizer(im)
+            if images is None:
+                images = np.empty((2*n_obs,) + normalized.shape, dtype=np.uint8)
+            images[start + i] = normalized
+
+    # The second half is the first half mirrored from left to right
+    images[n_obs:] = images[:n_obs, :, ::-1]
+    return images, np.concatenate((angs, -angs), axis=0).astype(np.float32)
+
+
+def array_batches(arrays, batch_size):
+    """
+    Endlessly yields consecutive batches of in-memory arrays, in order, E.G. the output of `validation_set`. Lets
+    Keras evaluate the arrays at a chosen batch size, as a generator with `nb_val_samples` set to their length.
+
+    :param arrays: Tuple of arrays with the same length, E.G. (images, angles, weights)
+    :param batch_size: Size of the batches. The last batch of each pass may be smaller.
+    :return: Tuple with a batch of each array
+    """
+    n_obs = arrays[0].shape[0]
+    assert all(a.shape[0] == n_obs for a in arrays), 'Different # of data and labels.'
+
+    while True:
+        for start in range(0, n_obs, batch_size):
+            yield tuple(a[start:start + batch_size] for a in arrays)
+
+
+def batch_generator(ims, angs, batch_size, augmentor, path, kwargs={}, validation=False, cache=None,
+                    weights=None):
     """
     Continuously generates batches from the provided images paths and angles.
 
@@ -348,6 +661,13 @@ def batch_generator(ims, angs, batch_size, augmentor, path, kwargs={}, validatio
     using `cv2.imread`. Note that this means the images will be read in BGR format. Lastly, the images
     and angles are fed into the provided augmentation function, `augmentor`, and then yielded.
 
+    If a `FrameCache` is given, the cropped HSV frames are gathered from it instead of being decoded,
+    so `augmentor` must expect cropped frames, E.G. `augment_batch` with `cropped=True`.
+
+    If `weights` are given, each epoch instead draws as many samples as there are in the dataset, with
+    replacement and in proportion to their weights, E.G. from `sampler.angle_weights`. The whole dataset
+    is kept, so the balance can be changed without reloading or discarding any data.
+
     :param ims: The filepaths to the images
     :param angs: The steering angles corresponding to the image paths
     :param batch_size: The size of batches to generate
@@ -358,11 +678,47 @@ def batch_generator(ims, angs, batch_size, augmentor, path, kwargs={}, validatio
                    `augmentor` function
     :param validation: A boolean indicating whether or not to expand the orphan batch
                        from the generator. See description above.
+    :param cache: Optional `FrameCache` holding every image in `ims`
+    :param weights: Optional sampling weight of each image
     :return: Generator producing an infinite number of batches adhering to the above policies
     """
+    # Shuffle and batch the rows of the cache instead of the paths
+    if cache is not None:
+        ims = cache.rows([path + im for im in ims])
+
+    for batch_x, batch_y in batch_indices(ims, angs, batch_size, validation, weights):
+        # Augment the images with the given function
+        batch_x, batch_y = augmentor(load_batch(batch_x, path, cache), batch_y, **kwargs)
+        yield batch_x, batch_y
+
+
+def batch_indices(ims, angs, batch_size, validation=False, weights=None):
+    """
+    Continuously shuffles the image paths, or cache rows, and angles and splits them into batches, in
+    the order described in `batch_generator`.
+
+    :param ims: The filepaths to the images, or their rows in a `FrameCache`
+    :param angs: The steering angles corresponding to the images
+    :param batch_size: The size of batches to generate
+    :param validation: A boolean indicating whether or not to expand the orphan batch
+    :param weights: Optional sampling weight of each image. See `batch_generator`.
+    :return: Generator producing an infinite number of (batch_ims, batch_angs) tuples
+    """
     n_obs = ims.shape[0]
     assert n_obs == angs.shape[0], 'Different # of data and labels.'
 
+    if weights is not None:
+        assert n_obs == weights.shape[0], 'Different # of data and weights.'
+        table = AliasTable(weights)
+        while True:
+            # Draw this epoch's samples in proportion to their weights
+            epoch = table.draw(n_obs)
+            for batch in range(0, n_obs, batch_size):
+                idx = epoch[batch:batch + batch_size]
+                if idx.shape[0] < batch_size and not validation:
+                    idx = np.concatenate((idx, table.draw(batch_size - idx.shape[0])))
+                yield ims[idx, ...], angs[idx, ...]
+
     while True:
         ims, angs = shuffle(ims, angs)
         batch_starts = np.arange(0, n_obs, batch_size)
@@ -381,9 +737,18 @@ def batch_generator(ims, angs, batch_size, augmentor, path, kwargs={}, validatio
                 rand_idx = np.random.randint(0, n_obs-1, next_idx - n_obs)
                 batch_x = np.concatenate((batch_x, ims[rand_idx, ...]), axis=0)
                 batch_y = np.concatenate((batch_y, angs[rand_idx, ...]), axis=0)
-
-            # Load the images from their paths
-            batch_x = np.array([cv2.cvtColor(cv2.imread(path + im), cv2.COLOR_BGR2HSV) for im in batch_x])
-            # Augment the images with the given function
-            batch_x, batch_y = augmentor(batch_x, batch_y, **kwargs)
             yield batch_x, batch_y
+
+
+def load_batch(batch_x, path, cache=None):
+    """
+    Loads a batch of HSV images from the cache or their paths.
+
+    :param batch_x: The filepaths to the images, or their rows in `cache`
+    :param path: A filepath which will be appended to the beginning of each image path
+    :param cache: Optional `FrameCache` to gather the images from
+    :return: Array of shape (n, h, w, 3)
+    """
+    if cache is not None:
+        return cache.gather(batch_x)
+    return np.array([cv2.cvtColor(cv2.imread(path + im), cv2.COLOR_BGR2HSV) for im in batch_x])
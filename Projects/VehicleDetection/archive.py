@@ -0,0 +1,100 @@
+import os
+import cv2
+import numpy as np
+
+
+# Archives opened in this process, keyed by path. Lets worker processes reuse one mapping per archive.
+_open_archives = {}
+
+
+def _dir_mtimes(dirs):
+    """
+    Modification time of each directory, or 0 for a directory which does not exist.
+    """
+    return np.array([os.path.getmtime(d) if os.path.isdir(d) else 0.0 for d in dirs])
+
+
+def pack_images(paths, labels, out_path, dirs=None):
+    """
+    Decodes equally sized images and packs them into a single contiguous uint8 array file, `<out_path>.npy`, along
+    with a sidecar, `<out_path>_index.npz`, holding the labels, original paths, and modification times, and the
+    modification times of the directories the images were found in.
+
+    Images are stored exactly as `cv2.imread` returns them, in BGR order.
+
+    :param paths: Image file paths
+    :param labels: Label for each image
+    :param out_path: Path of the archive without an extension
+    :param dirs: Directories the images were found in, which `ImageArchive.is_current` checks for added or removed
+        images. Defaults to the directories of `paths`.
+    :return: The packed `ImageArchive`
+    """
+    assert len(paths) == len(labels), 'Different # of images and labels.'
+    if len(paths) == 0:
+        raise ValueError('No images to pack into %s.' % out_path)
+    if dirs is None:
+        dirs = sorted(set(os.path.dirname(p) for p in paths))
+
+    # Written alongside and then moved into place, so any mapping of a previous archive at the same path stays valid
+    first = cv2.imread(paths[0])
+    images = np.lib.format.open_memmap(out_path + '.tmp.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(paths),) + first.shape)
+    for i, im_path in enumerate(paths):
+        images[i] = cv2.imread(im_path)
+    images.flush()
+    del images
+    os.replace(out_path + '.tmp.npy', out_path + '.npy')
+
+    np.savez(out_path + '_index.npz',
+             labels=np.asarray(labels, dtype=np.uint8),
+             paths=np.array(paths),
+             mtimes=np.array([os.path.getmtime(p) for p in paths]),
+             dirs=np.array(dirs),
+             dir_mtimes=_dir_mtimes(dirs))
+
+    # Drop any stale mapping of a previous archive at the same path
+    _open_archives.pop(out_path, None)
+    return ImageArchive(out_path)
+
+
+class ImageArchive(object):
+    def __init__(self, path):
+        """
+        Read-only view of an image archive written by `pack_images`. The images are memory-mapped, so opening an
+        archive does not read any pixel data, and pickling one only sends its path to the receiving process.
+
+        :param path: Path of the archive without an extension
+        """
+        self.path = path
+        if path not in _open_archives:
+            with np.load(path + '_index.npz') as index:
+                # Archives packed before the directories were stored are never current
+                dirs, dir_mtimes = ((index['dirs'], index['dir_mtimes']) if 'dirs' in index.files
+                                    else (np.array([path]), np.array([np.nan])))
+                _open_archives[path] = (np.load(path + '.npy', mmap_mode='r'),
+                                        index['labels'], index['paths'], index['mtimes'], dirs, dir_mtimes)
+        self.images, self.labels, self.paths, self.mtimes, self.dirs, self.dir_mtimes = _open_archives[path]
+
+    @staticmethod
+    def exists(path):
+        """
+        Whether an archive has been packed at `path`.
+        """
+        return os.path.exists(path + '.npy') and os.path.exists(path + '_index.npz')
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def is_current(self):
+        """
+        Whether no images have been added to or removed from the directories the archive was packed from, E.G. by
+        `mining.py`. Only the directories are checked, so this does not list or stat every image, and an image which
+        is overwritten in place is not noticed. Repack with `classifier.pack_data` after editing images.
+        """
+        return np.array_equal(self.dir_mtimes, _dir_mtimes(self.dirs))
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
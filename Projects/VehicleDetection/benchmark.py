@@ -0,0 +1,233 @@
+import os
+import glob
+import json
+import time
+import platform
+import resource
+import argparse
+import cv2
+import numpy as np
+from collections import defaultdict
+from moviepy.editor import VideoFileClip
+
+from VehicleDetection.pipeline import load_detector
+from VehicleDetection.processing import draw_boxes
+
+
+# Stages timed by `CarDetector`, in the order they run
+STAGES = ['color_conversion', 'hog', 'color_features', 'prefilter', 'scoring', 'heatmap', 'labelling', 'drawing']
+
+
+def box_iou(a, b):
+    """
+    Intersection over union of two boxes.
+
+    :param a: Box as ((x_min, y_min), (x_max, y_max))
+    :param b: Box as ((x_min, y_min), (x_max, y_max))
+    :return: IoU in [0, 1]
+    """
+    (ax1, ay1), (ax2, ay2) = a
+    (bx1, by1), (bx2, by2) = b
+    inter = max(0, min(ax2, bx2) - max(ax1, bx1)) * max(0, min(ay2, by2) - max(ay1, by1))
+    union = (ax2 - ax1) * (ay2 - ay1) + (bx2 - bx1) * (by2 - by1) - inter
+    return inter / union if union > 0 else 0.
+
+
+def match_boxes(boxes, golden, min_iou=0.5):
+    """
+    Greedily matches detected boxes to golden boxes, highest IoU first.
+
+    :param boxes: Detected boxes
+    :param golden: Reference boxes
+    :param min_iou: Minimum IoU for two boxes to match.
+    :return: Dictionary with the number of `matched`, `missed` and `extra` boxes, and the `ious` of the matches.
+    """
+    pairs = sorted(((box_iou(b, g), i, j) for i, b in enumerate(boxes) for j, g in enumerate(golden)), reverse=True)
+
+    used_boxes, used_golden, ious = set(), set(), []
+    for iou, i, j in pairs:
+        if iou < min_iou:
+            break
+        if i in used_boxes or j in used_golden:
+            continue
+        used_boxes.add(i)
+        used_golden.add(j)
+        ious.append(iou)
+
+    return {
+        'matched': len(ious),
+        'missed': len(golden) - len(ious),
+        'extra': len(boxes) - len(ious),
+        'ious': ious
+      }
+
+
+def time_frames(detector, frames):
+    """
+    Detects and draws the cars in every frame in order, recording how long each stage of the detector takes.
+
+    The heatmap history and tracks are cleared first, so the same frames always give the same boxes.
+
+    :param detector: The `CarDetector` to benchmark.
+    :param frames: Iterable of RGB images.
+    :return: Dictionary with the `boxes` and `n_windows` of each frame, the total `seconds`, and the seconds spent
+        in each stage, `timings`.
+    """
+    detector.frame_buffer = []
+    detector.tracks = []
+    detector.frame_count = 0
+    detector.timings = defaultdict(float)
+
+    boxes, n_windows = [], []
+    t = time.perf_counter()
+    try:
+        for im in frames:
+            detections = detector.detect(im)
+            t_draw = time.perf_counter()
+            draw_boxes(im, detections['boxes'])
+            detector.timings['drawing'] += time.perf_counter() - t_draw
+            boxes.append([[[int(x), int(y)] for x, y in box] for box in detections['boxes']])
+            n_windows.append(detections['n_windows'])
+    finally:
+        t = time.perf_counter() - t
+        timings = detector.timings
+        detector.timings = None
+
+    return {
+        'boxes': boxes,
+        'n_windows': n_windows,
+        'seconds': t,
+        'timings': {stage: timings[stage] for stage in STAGES}
+      }
+
+
+def summarize(result):
+    """
+    Throughput of a `time_frames` result, with the stage timings converted to milliseconds per frame.
+    """
+    n_frames = max(len(result['boxes']), 1)
+    total_windows = int(np.sum(result['n_windows']))
+    return {
+        'frames': len(result['boxes']),
+        'seconds': result['seconds'],
+        'fps': len(result['boxes']) / result['seconds'] if result['seconds'] > 0 else 0.,
+        'windows': total_windows,
+        'windows_per_frame': total_windows / n_frames,
+        'windows_per_second': total_windows / result['seconds'] if result['seconds'] > 0 else 0.,
+        'ms_per_frame': {stage: 1000 * s / n_frames for stage, s in result['timings'].items()}
+      }
+
+
+def compare_to_golden(boxes, golden, min_iou=0.5):
+    """
+    Compares the boxes of every frame with the golden boxes of the same frame.
+
+    :param boxes: Dictionary mapping frame names to their detected boxes.
+    :param golden: Dictionary mapping frame names to their golden boxes.
+    :param min_iou: Minimum IoU for a detection to match a golden box.
+    :return: Dictionary with the totals of `match_boxes`, the `mean_iou` of the matches, the frames which are
+        not identical to the golden ones, and whether every frame matched, `passed`.
+    """
+    totals = {'matched': 0, 'missed': 0, 'extra': 0}
+    ious, changed = [], []
+    for name, frame_boxes in sorted(boxes.items()):
+        if name not in golden:
+            continue
+        match = match_boxes(frame_boxes, golden[name], min_iou)
+        for key in totals:
+            totals[key] += match[key]
+        ious.extend(match['ious'])
+        if match['missed'] or match['extra']:
+            changed.append(name)
+
+    return dict(totals,
+                mean_iou=float(np.mean(ious)) if ious else None,
+                changed_frames=changed,
+                passed=not changed)
+
+
+def run_benchmark(detector, image_dir='VehicleDetection/test_images/', video='VehicleDetection/test_video.mp4',
+                  n_repeats=3):
+    """
+    Benchmarks the detector on the test images and the test video. Each test image is searched as a fresh,
+    single frame; the video is searched in order, so the heatmap history and any tracking take effect.
+
+    :param detector: The `CarDetector` to benchmark.
+    :param image_dir: Directory of `.jpg` test images.
+    :param video: Path to the test video, or None to skip it.
+    :param n_repeats: Number of times the test images are timed. The fastest run is reported.
+    :return: Tuple containing (report, boxes), where `boxes` maps every frame name to its detected boxes.
+    """
+    report, boxes = {}, {}
+
+    paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')))
+    if paths:
+        images = [cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2RGB) for p in paths]
+
+        runs = []
+        for _ in range(n_repeats):
+            runs.append([time_frames(detector, [im]) for im in images])
+        best = min(runs, key=lambda run: sum(r['seconds'] for r in run))
+
+        result = {
+            'boxes': [r['boxes'][0] for r in best],
+            'n_windows': [r['n_windows'][0] for r in best],
+            'seconds': sum(r['seconds'] for r in best),
+            'timings': {stage: sum(r['timings'][stage] for r in best) for stage in STAGES}
+          }
+        report['images'] = summarize(result)
+        report['images']['windows_per_image'] = dict(zip(map(os.path.basename, paths), result['n_windows']))
+        boxes.update(zip(map(os.path.basename, paths), result['boxes']))
+
+    if video is not None and os.path.exists(video):
+        frames = list(VideoFileClip(video).iter_frames())
+        result = time_frames(detector, frames)
+        report['video'] = summarize(result)
+        name = os.path.basename(video)
+        boxes.update(('%s:%05d' % (name, i), b) for i, b in enumerate(result['boxes']))
+
+    # Kilobytes on Linux
+    report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report, boxes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vehicle Detection Benchmark')
+    parser.add_argument('--out', default=None, help='Path to write the JSON report to. Printed if not given.')
+    parser.add_argument('--golden', default='VehicleDetection/benchmark_golden.json',
+                        help='JSON file of the reference boxes for every frame.')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='Overwrite the golden boxes with the boxes of this run.')
+    parser.add_argument('--min-iou', type=float, default=0.5, help='Minimum IoU for a box to match.')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times to time the test images.')
+    parser.add_argument('--no-video', action='store_true', help='Only benchmark the test images.')
+    args = parser.parse_args()
+
+    # Tracking only searches part of each frame, so the benchmark always runs a full search
+    detector = load_detector(tracking=False)
+
+    report, boxes = run_benchmark(detector, video=None if args.no_video else 'VehicleDetection/test_video.mp4',
+                                  n_repeats=args.repeats)
+    report['platform'] = {'python': platform.python_version(), 'machine': platform.machine(),
+                          'cv2': cv2.__version__, 'numpy': np.__version__}
+    report['settings'] = {'hog_backend': detector.hog_backend, 'scale': detector.scale,
+                          'prefilter': detector.prefilter is not None}
+
+    if args.update_golden:
+        with open(args.golden, 'w') as f:
+            json.dump(boxes, f, indent=1, sort_keys=True)
+        print('Wrote golden boxes for %d frames to %s' % (len(boxes), args.golden))
+    elif os.path.exists(args.golden):
+        with open(args.golden) as f:
+            report['accuracy'] = compare_to_golden(boxes, json.load(f), args.min_iou)
+    else:
+        print('No golden boxes at %s, run with --update-golden to create them.' % args.golden)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if 'accuracy' in report and not report['accuracy']['passed']:
+        raise SystemExit('Detections changed in %d frames.' % len(report['accuracy']['changed_frames']))
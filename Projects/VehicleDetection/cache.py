@@ -0,0 +1,107 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+
+
+class FeatureCache(object):
+    def __init__(self, cache_dir, params):
+        """
+        On-disk cache of extracted feature vectors. Each set of feature parameters gets its own subdirectory, so
+        parameter sweeps never invalidate each other. Features are written in chunks of `.npy` files which are
+        memory-mapped when read, and an index maps every image path to its chunk and row. An entry is only valid
+        while the modification time of the image matches the one it was computed from.
+
+        :param cache_dir: Root directory of the cache.
+        :param params: Dictionary of the parameters passed to `single_img_features`.
+        """
+        self.params = params
+        key = repr(sorted(params.items())).encode('utf-8')
+        self.path = os.path.join(cache_dir, hashlib.md5(key).hexdigest()[:16])
+        self._index_file = os.path.join(self.path, 'index.p')
+        self._chunks = {}
+
+        if os.path.exists(self._index_file):
+            with open(self._index_file, 'rb') as f:
+                self._state = pickle.load(f)
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            self._state = {'params': params, 'n_chunks': 0, 'index': {}}
+
+    def missing(self, paths, mtimes=None):
+        """
+        Returns the paths which have no valid entry in the cache.
+
+        :param paths: Image file paths
+        :param mtimes: Modification time of each image. Read from the file system if not given.
+        :return: List of paths to extract features for.
+        """
+        if mtimes is None:
+            mtimes = [os.path.getmtime(p) for p in paths]
+        index = self._state['index']
+        return [p for p, mtime in zip(paths, mtimes) if p not in index or index[p][0] != mtime]
+
+    def new_chunk(self, paths, n_features, dtype=np.float64):
+        """
+        Allocates a memory-mapped chunk to write the features of `paths` into. The chunk is only added to the
+        index once `commit` is called with it.
+
+        :param paths: Image file paths which will be stored in the chunk, in order.
+        :param n_features: Length of each feature vector.
+        :param dtype: Data type of the feature vectors.
+        :return: Writable array of shape (len(paths), n_features) backed by the chunk file.
+        """
+        chunk_file = os.path.join(self.path, 'chunk_%05d.npy' % self._state['n_chunks'])
+        return np.lib.format.open_memmap(chunk_file, mode='w+', dtype=dtype, shape=(len(paths), n_features))
+
+    def commit(self, paths, chunk, mtimes=None):
+        """
+        Flushes a chunk from `new_chunk` to disk and records its rows in the index.
+
+        :param paths: The same paths the chunk was allocated with.
+        :param chunk: Array returned by `new_chunk`.
+        :param mtimes: Modification time of each image. Read from the file system if not given.
+        """
+        if mtimes is None:
+            mtimes = [os.path.getmtime(p) for p in paths]
+
+        chunk.flush()
+        chunk_id = self._state['n_chunks']
+        for row, (p, mtime) in enumerate(zip(paths, mtimes)):
+            self._state['index'][p] = (mtime, chunk_id, row)
+        self._state['n_chunks'] += 1
+
+        # Write to a temporary file first so an interrupted run never leaves a corrupt index behind
+        tmp_file = self._index_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self._state, f)
+        os.replace(tmp_file, self._index_file)
+
+    def gather(self, paths):
+        """
+        Loads the cached feature vectors for `paths`. Every path must have a valid entry.
+
+        :param paths: Image file paths
+        :return: Array of shape (len(paths), n_features).
+        """
+        index = self._state['index']
+        entries = [index[p] for p in paths]
+
+        first = self._chunk(entries[0][1])
+        features = np.empty((len(paths), first.shape[1]), dtype=first.dtype)
+
+        chunk_ids = np.array([e[1] for e in entries])
+        rows = np.array([e[2] for e in entries])
+        for chunk_id in np.unique(chunk_ids):
+            mask = chunk_ids == chunk_id
+            features[mask] = self._chunk(chunk_id)[rows[mask]]
+        return features
+
+    def _chunk(self, chunk_id):
+        """
+        Memory-maps a chunk file, reusing the mapping if it is already open.
+        """
+        if chunk_id not in self._chunks:
+            chunk_file = os.path.join(self.path, 'chunk_%05d.npy' % chunk_id)
+            self._chunks[chunk_id] = np.load(chunk_file, mmap_mode='r')
+        return self._chunks[chunk_id]
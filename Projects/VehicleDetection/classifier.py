@@ -1,53 +1,106 @@
 import numpy as np
+import cv2
 import glob
 import time
 import os
 import pickle
+import json
 from sklearn.svm import LinearSVC
+from sklearn.linear_model import SGDClassifier
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
 from sklearn.utils import shuffle
 
-from VehicleDetection.processing import extract_features
+from VehicleDetection.archive import ImageArchive, pack_images
+# `LinearModel`, `Prefilter` and `load_model` are also re-exported, so prefilters pickled from this module still load
+from VehicleDetection.linear import MODEL_FORMAT_VERSION, LinearModel, Prefilter, load_model
+from VehicleDetection.processing import extract_features, cache_features, default_feature_params
 
 
-def load_data():
+VEHICLE_FOLDERS = [
+    'vehicles/GTI_Far/',
+    'vehicles/GTI_Left/',
+    'vehicles/GTI_MiddleClose/',
+    'vehicles/GTI_Right/',
+    'vehicles/KITTI_extracted/'
+  ]
+NON_VEHICLE_FOLDERS = [
+    'non-vehicles/Extras/',
+    'non-vehicles/GTI/',
+    # Hard negatives from `mining.py`
+    'non-vehicles/Mined/'
+  ]
+
+
+def find_images(data_dir):
+    """
+    Globs the Car and Not-Car image paths from the `Data` directory.
+
+    :param data_dir: Path to the `Data` directory
+    :return: Tuple containing (paths, labels)
+    """
+    paths, labels = [], []
+
+    for folder in VEHICLE_FOLDERS:
+        for im_path in glob.glob(data_dir + folder + '*.png'):
+            paths.append(im_path)
+            labels.append(1)
+
+    for folder in NON_VEHICLE_FOLDERS:
+        for im_path in glob.glob(data_dir + folder + '*.png'):
+            paths.append(im_path)
+            labels.append(0)
+    return paths, labels
+
+
+def _pack(data_dir):
+    """
+    Packs every Car and Not-Car image in `data_dir` into the archive `<data_dir>/dataset`, and records the image
+    folders so added or removed images are noticed.
+    """
+    paths, labels = find_images(data_dir)
+    return pack_images(paths, labels, data_dir + 'dataset',
+                       dirs=[data_dir + folder for folder in VEHICLE_FOLDERS + NON_VEHICLE_FOLDERS])
+
+
+def pack_data():
     """
-    Loads the Car and Not-Car data from the`Data` directory and scales the features.
+    Packs every Car and Not-Car image in the `Data` directory into a single memory-mappable archive, `Data/dataset`.
+    """
+    return _pack(os.getcwd() + '/VehicleDetection/Data/')
+
 
+def _dataset(data_dir):
+    """
+    Returns the packed archive in `data_dir` if it exists, otherwise the individual image paths, along with their
+    labels. An archive whose image folders have changed, E.G. after `mining.py` has added hard negatives, is
+    repacked first. A current archive is used without listing the images.
+    """
+    if ImageArchive.exists(data_dir + 'dataset'):
+        images = ImageArchive(data_dir + 'dataset')
+        if not images.is_current():
+            print('The images have changed since they were packed, repacking them...')
+            images = _pack(data_dir)
+        return images, images.labels.astype(np.int64)
+    paths, labels = find_images(data_dir)
+    return paths, np.array(labels)
+
+
+def load_data(dtype='float32'):
+    """
+    Loads the Car and Not-Car data from the`Data` directory and scales the features. If the data has been packed
+    with `pack_data`, the images are read from the archive instead of the individual files.
+
+    :param dtype: Name of the data type to extract the features in.
     :return: Dictionary with keys ['features', 'labels', 'scaler', 'v_cnt', 'nv_cnt'].
     """
     cwd = os.getcwd() + '/VehicleDetection/Data/'
-    vehicle_folders = [
-        'vehicles/GTI_Far/',
-        'vehicles/GTI_Left/',
-        'vehicles/GTI_MiddleClose/',
-        'vehicles/GTI_Right/',
-        'vehicles/KITTI_extracted/'
-      ]
-    non_vehicle_folders = [
-        'non-vehicles/Extras/',
-        'non-vehicles/GTI/'
-      ]
-
-    data = {'features': [], 'labels': [], 'v_cnt': 0, 'nv_cnt': 0}
-
-    for folder in vehicle_folders:
-        for im_path in glob.glob(cwd + folder + '*.png'):
-            data['features'].append(im_path)
-            data['labels'].append(1)
-            data['v_cnt'] += 1
-
-    for folder in non_vehicle_folders:
-        for im_path in glob.glob(cwd + folder + '*.png'):
-            data['features'].append(im_path)
-            data['labels'].append(0)
-            data['nv_cnt'] += 1
-
-    data['features'] = extract_features(data['features'])
+    images, labels = _dataset(cwd)
+
+    data = {'labels': labels, 'v_cnt': int(np.sum(labels == 1)), 'nv_cnt': int(np.sum(labels == 0))}
+    data['features'] = extract_features(images, cache_dir=cwd + '.feature_cache/', dtype=dtype)
     data['scaler'] = StandardScaler().fit(data['features'])
     data['features'] = data['scaler'].transform(data['features'])
-    data['labels'] = np.array(data['labels'])
     return data
 
 
@@ -60,15 +113,104 @@ def shuffle_and_split(data):
     return X_train, X_test, y_train, y_test
 
 
-def train():
+def to_float32(model, scaler):
+    """
+    Casts the fitted parameters of a linear model and its scaler to float32 in place, so float32 feature vectors are
+    scaled and scored without being upcast to float64.
+
+    :param model: Trained linear model with `coef_` and `intercept_`, E.G. `LinearSVC` or `SGDClassifier`
+    :param scaler: A fit `StandardScaler`
+    :return: Tuple containing (model, scaler)
+    """
+    model.coef_ = np.ascontiguousarray(model.coef_, dtype=np.float32)
+    model.intercept_ = model.intercept_.astype(np.float32)
+    scaler.mean_ = scaler.mean_.astype(np.float32)
+    scaler.scale_ = scaler.scale_.astype(np.float32)
+    scaler.var_ = scaler.var_.astype(np.float32)
+    return model, scaler
+
+
+def fold_scaler(model, scaler):
+    """
+    Folds a scaler into the weights and bias of the linear model trained after it.
+
+    With scaler mean `mu` and scale `s`, the score `((x - mu) / s) @ coef + b` is `x @ (coef / s) + b - (mu / s) @ coef`.
+
+    :param model: Trained linear model with `coef_` and `intercept_`, E.G. `LinearSVC` or `SGDClassifier`
+    :param scaler: The `StandardScaler` the model was trained after
+    :return: Tuple containing (weights, bias), with float32 weights of shape (n_features,).
+    """
+    coef = model.coef_.ravel().astype(np.float64)
+    weights = coef / scaler.scale_
+    bias = float(model.intercept_[0]) - (scaler.mean_ / scaler.scale_).dot(coef)
+    return weights.astype(np.float32), float(bias)
+
+
+def _export_linear(weights, bias, path, header):
+    """
+    Writes the weights of a linear model to `<path>.npy`, and its bias along with `header` to `<path>.json`.
+    """
+    if not np.any(weights):
+        raise ValueError('Every weight of the model is zero, so it scores every window the same. '
+                         'Train it with a larger `l1_C`.')
+    np.save(path + '.npy', weights)
+
+    header = dict(header, version=MODEL_FORMAT_VERSION, bias=bias, n_features=int(weights.shape[0]))
+    with open(path + '.json', 'w') as f:
+        json.dump(header, f, indent=2, sort_keys=True)
+
+
+def export_model(model, scaler, path='VehicleDetection/model', **params):
+    """
+    Folds the scaler into the weights and bias of a linear model and writes them to a compact format which
+    `linear.load_model` loads without sklearn: the float32 weights in `<path>.npy`, and a versioned header with the
+    bias and the feature parameters in `<path>.json`.
+
+    :param model: Trained linear model with `coef_` and `intercept_`, E.G. `LinearSVC` or `SGDClassifier`
+    :param scaler: The `StandardScaler` the model was trained after
+    :param path: Path of the model files without an extension
+    :param params: Any feature parameters which differ from the defaults of `single_img_features`
+    """
+    weights, bias = fold_scaler(model, scaler)
+    _export_linear(weights, bias, path, dict(default_feature_params(), **params))
+
+
+def export_prefilter(prefilter, path='VehicleDetection/prefilter'):
+    """
+    Writes a trained `Prefilter` in the format of `export_model`, which `linear.load_prefilter` loads without
+    sklearn.
+
+    :param prefilter: `Prefilter` with a linear model and the `StandardScaler` it was trained after
+    :param path: Path of the prefilter files without an extension
+    """
+    weights, bias = fold_scaler(prefilter.model, prefilter.scaler)
+    _export_linear(weights, bias, path, {'threshold': float(prefilter.threshold),
+                                         'spatial_size': list(prefilter.spatial_size),
+                                         'hist_bins': prefilter.hist_bins})
+
+
+def train(l1_C=None, dtype='float32'):
     """
     Loads and splits the training data, trains a linear SVM on it, evaluates it's perfromance, and returns the
-    model along with the associated scaler for the features.
+    model along with the associated scaler for the features. The model is also exported with `export_model`, and
+    the prefilter for the detection cascade is trained and saved as well.
+
+    If `l1_C` is given, the SVM is trained with an L1 penalty of inverse strength `l1_C`, which drives the weights
+    of most features to exactly zero. The detector never computes the features with a zero weight in the exported
+    model, so a smaller `l1_C` trades accuracy for fewer features to extract and score. An SVM is also trained on
+    every feature so the accuracy trade-off can be reported.
+
+    The features are extracted in `dtype`, and with float32 the model and scaler are stored in float32 as well. The
+    accuracy before and after casting them is reported, and training with `dtype='float64'` gives the baseline for
+    the whole pipeline.
+
+    :param l1_C: Optional inverse regularization strength of an L1 penalised SVM
+    :param dtype: Name of the data type of the feature vectors
     """
     print('Loading the data...')
     t = time.clock()
 
-    data = load_data()
+    data = load_data(dtype)
     X_scaler = data['scaler']
 
     t = abs(time.clock() - t)
@@ -79,7 +221,11 @@ def train():
     print('Split the data into %d training and %d testing examples.' % (y_train.shape[0], y_test.shape[0]))
     del data
 
-    model = LinearSVC()
+    if l1_C is not None:
+        full_accuracy = LinearSVC().fit(X_train, y_train).score(X_test, y_test)
+        model = LinearSVC(penalty='l1', dual=False, C=l1_C)
+    else:
+        model = LinearSVC()
     print('Training the model...')
 
     t = time.clock()
@@ -88,7 +234,169 @@ def train():
 
     print('Model trained in %d seconds.' % t)
     print('Model accuracy: %0.4f' % model.score(X_test, y_test))
+    if l1_C is not None:
+        print('Model uses %d of %d features.' % (np.count_nonzero(model.coef_), model.coef_.shape[1]))
+        print('Model accuracy with every feature: %0.4f' % full_accuracy)
+
+    if dtype == 'float32':
+        model, X_scaler = to_float32(model, X_scaler)
+        print('Model accuracy with float32 parameters: %0.4f' % model.score(X_test, y_test))
 
     with open('VehicleDetection/model.p', 'wb') as f:
         pickle.dump([model, X_scaler], f)
+    export_model(model, X_scaler, dtype=dtype)
+
+    # Train the first stage of the cascade alongside the main model
+    train_prefilter(dtype=dtype)
     return model, X_scaler
+
+
+def train_prefilter(recall=0.995, spatial_size=(8, 8), hist_bins=32, dtype='float32'):
+    """
+    Trains the first stage of the detection cascade on the spatial and color histogram features, and sets its
+    threshold so that it keeps `recall` of the cars in a calibration set. The recall and the proportion of non-car
+    images it rejects are reported on a separate test set, which the threshold was not chosen on, along with the
+    proportion of the detector's search windows of the test images it passes on.
+
+    :param recall: Proportion of cars the prefilter should keep
+    :param spatial_size: Size transform tuple for the spatial features
+    :param hist_bins: Number of histogram bins for color_hist
+    :param dtype: Name of the data type of the feature vectors
+    :return: The trained `Prefilter`
+    """
+    print('Training the prefilter...')
+
+    cwd = os.getcwd() + '/VehicleDetection/Data/'
+    images, labels = _dataset(cwd)
+    features = extract_features(images, cache_dir=cwd + '.feature_cache/', spatial_size=spatial_size,
+                                hist_bins=hist_bins, hog_feat=False, dtype=dtype)
+
+    X_train, X_test, y_train, y_test = train_test_split(*shuffle(features, labels), test_size=0.2)
+    X_train, X_calib, y_train, y_calib = train_test_split(X_train, y_train, test_size=0.2)
+    scaler = StandardScaler().fit(X_train)
+    model = LinearSVC().fit(scaler.transform(X_train), y_train)
+    if dtype == 'float32':
+        model, scaler = to_float32(model, scaler)
+
+    # Choose the threshold which keeps the requested proportion of the calibration cars
+    scores = model.decision_function(scaler.transform(X_calib))
+    threshold = np.percentile(scores[y_calib == 1], 100 * (1 - recall))
+
+    prefilter = Prefilter(model, scaler, threshold, spatial_size, hist_bins)
+    kept = prefilter.keep(X_test)
+    print('Prefilter recall: %0.4f' % np.mean(kept[y_test == 1]))
+    print('Prefilter rejects %0.2f%% of non-car images and %0.2f%% of all images.'
+          % (100 * (1 - np.mean(kept[y_test == 0])), 100 * (1 - np.mean(kept))))
+
+    with open('VehicleDetection/prefilter.p', 'wb') as f:
+        pickle.dump(prefilter, f)
+    export_prefilter(prefilter)
+
+    # The training images are mostly centered cars, unlike the windows of a frame, so measure the windows it passes
+    if os.path.exists('VehicleDetection/model.json') or os.path.exists('VehicleDetection/model.p'):
+        n_kept, n_windows = prefilter_survivors()
+        print('Prefilter passes %0.2f%% of the %d search windows of the test images.'
+              % (100 * n_kept / max(n_windows, 1), n_windows))
+    return prefilter
+
+
+def prefilter_survivors(image_dir='VehicleDetection/test_images/'):
+    """
+    Searches the test images with the detector from `pipeline.load_detector`, and counts the sliding windows which
+    its prefilter passes on to the full classifier.
+
+    :param image_dir: Directory of `.jpg` test images
+    :return: Tuple containing (windows passed, windows searched)
+    """
+    # The pipeline is only needed here, and loads the model this module trains
+    from VehicleDetection.pipeline import load_detector
+    detector = load_detector()
+
+    n_kept, n_windows = 0, 0
+    for path in sorted(glob.glob(os.path.join(image_dir, '*.jpg'))):
+        bboxes, _ = detector.score_windows(cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB))
+        n_kept += bboxes.shape[0]
+        n_windows += detector.n_windows
+    return n_kept, n_windows
+
+
+def _chunks(idx, chunk_size):
+    """
+    Splits an index array into consecutive chunks of at most `chunk_size`.
+    """
+    return [idx[i:i + chunk_size] for i in range(0, idx.shape[0], chunk_size)]
+
+
+def _chunked_accuracy(model, scaler, cache, keys, labels, idx, chunk_size):
+    """
+    Accuracy of the model on the cached features of `idx`, loaded `chunk_size` at a time.
+    """
+    n_correct = 0
+    for chunk in _chunks(np.sort(idx), chunk_size):
+        n_correct += np.sum(model.predict(scaler.transform(cache.gather(keys[chunk]))) == labels[chunk])
+    return n_correct / idx.shape[0]
+
+
+def train_incremental(chunk_size=2048, n_epochs=5, alpha=1e-4, dtype='float32'):
+    """
+    Trains a linear SVM with stochastic gradient descent while only holding `chunk_size` feature vectors in memory
+    at a time, so the size of the dataset is bounded by disk rather than RAM.
+
+    The features are extracted into the on-disk feature cache, the scaler is fit with `partial_fit` over one pass
+    of the training chunks, and the model is fit on minibatches for `n_epochs` passes. The saved model has the same
+    `[model, X_scaler]` format as `train`.
+
+    :param chunk_size: Number of feature vectors to load at a time
+    :param n_epochs: Number of passes over the training set
+    :param alpha: Regularization strength of the SVM
+    :param dtype: Name of the data type of the feature vectors
+    :return: The trained model and scaler
+    """
+    print('Caching the features...')
+    t = time.time()
+
+    cwd = os.getcwd() + '/VehicleDetection/Data/'
+    images, labels = _dataset(cwd)
+    cache, keys = cache_features(images, cwd + '.feature_cache/', dtype=dtype)
+    keys = np.array(keys)
+
+    print('Cached %d car images and %d non-car images in %d seconds.'
+          % (np.sum(labels == 1), np.sum(labels == 0), time.time() - t))
+
+    train_idx, test_idx = train_test_split(np.arange(labels.shape[0]))
+    print('Split the data into %d training and %d testing examples.' % (train_idx.shape[0], test_idx.shape[0]))
+
+    # Gather chunks in sorted order so reads from the cache are as sequential as possible
+    X_scaler = StandardScaler()
+    for chunk in _chunks(np.sort(train_idx), chunk_size):
+        X_scaler.partial_fit(cache.gather(keys[chunk]))
+
+    model = SGDClassifier(loss='hinge', alpha=alpha)
+    print('Training the model...')
+
+    t = time.time()
+    for epoch in range(n_epochs):
+        for chunk in _chunks(shuffle(train_idx), chunk_size):
+            X = X_scaler.transform(cache.gather(keys[chunk]))
+            model.partial_fit(X, labels[chunk], classes=[0, 1])
+    t = time.time() - t
+
+    print('Model trained in %d seconds.' % t)
+    print('Model accuracy: %0.4f' % _chunked_accuracy(model, X_scaler, cache, keys, labels, test_idx, chunk_size))
+
+    if dtype == 'float32':
+        model, X_scaler = to_float32(model, X_scaler)
+        print('Model accuracy with float32 parameters: %0.4f'
+              % _chunked_accuracy(model, X_scaler, cache, keys, labels, test_idx, chunk_size))
+
+    with open('VehicleDetection/model.p', 'wb') as f:
+        pickle.dump([model, X_scaler], f)
+    export_model(model, X_scaler, dtype=dtype)
+    return model, X_scaler
+
+
+if __name__ == '__main__':
+    print('Packing the data...')
+    t = time.time()
+    archive = pack_data()
+    print('Packed %d images in %d seconds.' % (len(archive), time.time() - t))
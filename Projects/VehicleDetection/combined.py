@@ -0,0 +1,140 @@
+import json
+import time
+import argparse
+import threading
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from moviepy.editor import VideoFileClip
+
+from AdvLaneLines.pipeline import LaneFinder, perspective_points
+from AdvLaneLines.processing import calibrate_camera, undistort_maps
+from VehicleDetection.pipeline import load_detector
+from VehicleDetection.processing import draw_boxes
+from VehicleDetection.video import VideoRunner
+
+
+class RoadRunner(object):
+    def __init__(self, lane_finder, detector, queue_size=16):
+        """
+        Finds the lane and the cars in a video in a single pass. Each frame is decoded once, undistorted once with
+        the lane finder's calibration, and the same undistorted frame is searched by the `LaneFinder` on a worker
+        thread while the `CarDetector` searches it on the calling thread. Both are stateful across frames, so each
+        still sees the frames in order. Decoding and encoding run on their own threads, as in `VideoRunner`.
+
+        OpenCV and NumPy release the GIL for the heavy operations of both searches, so they overlap on separate
+        cores without the cost of sending the frames between processes.
+
+        :param lane_finder: The `LaneFinder` to run. Its `M` and `dist` are used to undistort every frame.
+        :param detector: The `CarDetector` to run.
+        :param queue_size: Maximum number of frames waiting in each queue.
+        """
+        self.lane_finder = lane_finder
+        self.detector = detector
+        self.queue_size = queue_size
+        self.stats = {}
+
+    def stream(self, infile):
+        """
+        Decodes, undistorts and searches every frame of `infile`, yielding the results in frame order. Once the
+        stream is exhausted, `stats` holds the number of frames, frames per second, and the mean seconds per frame
+        spent undistorting, in the car search, and waiting on the lane search after the car search finished.
+
+        :param infile: Path to the input video.
+        :return: Generator of (lane_output, lane, detections) tuples, where `lane_output` is the undistorted frame
+            annotated with the lane and `lane` and `detections` are the structured outputs of `LaneFinder.process`
+            and `CarDetector.detect`.
+        """
+        clip = VideoFileClip(infile)
+        decoded = Queue(self.queue_size)
+        timings = {'undistort': 0., 'cars': 0., 'lane_wait': 0.}
+
+        # Computed once, rather than on every call to `cv2.undistort`
+        map1, map2 = undistort_maps(self.lane_finder.M, self.lane_finder.dist, tuple(clip.size))
+
+        decoder = threading.Thread(target=VideoRunner._decode, args=(clip, decoded), daemon=True)
+
+        t = time.time()
+        decoder.start()
+
+        n_frames = 0
+        with ThreadPoolExecutor(max_workers=1) as lanes:
+            for im in iter(decoded.get, None):
+                t_stage = time.time()
+                undistorted = cv2.remap(im, map1, map2, cv2.INTER_LINEAR)
+                timings['undistort'] += time.time() - t_stage
+
+                # Neither search modifies the frame, so both read the same buffer
+                lane_result = lanes.submit(self.lane_finder.process, undistorted)
+
+                t_stage = time.time()
+                detections = self.detector.detect(undistorted)
+                timings['cars'] += time.time() - t_stage
+
+                t_stage = time.time()
+                lane_output, lane = lane_result.result()
+                timings['lane_wait'] += time.time() - t_stage
+
+                n_frames += 1
+                yield lane_output, lane, detections
+
+        decoder.join()
+        t = time.time() - t
+
+        self.stats = dict(
+            {stage + '_seconds': s / max(n_frames, 1) for stage, s in timings.items()},
+            frames=n_frames,
+            fps=n_frames / t)
+
+    def run(self, infile, outfile=None, export=None):
+        """
+        Composites the lane and the detected cars onto every frame of `infile`, and writes the video to `outfile`
+        and the structured outputs to `export`.
+
+        :param infile: Path to the input video.
+        :param outfile: Optional path to write the annotated video to.
+        :param export: Optional path to write one JSON object per frame to, with keys ['frame', 'lane', 'boxes',
+            'peaks', 'n_windows'].
+        :return: `stats`
+        """
+        encoded, encoder = None, None
+        if outfile is not None:
+            encoded = Queue(self.queue_size)
+            encoder = threading.Thread(target=VideoRunner._encode, args=(VideoFileClip(infile), outfile, encoded))
+            encoder.start()
+
+        f = open(export, 'w') if export is not None else None
+        try:
+            for i, (lane_output, lane, detections) in enumerate(self.stream(infile)):
+                if encoded is not None:
+                    encoded.put(draw_boxes(lane_output, detections['boxes']))
+                if f is not None:
+                    f.write(json.dumps(dict(detections, frame=i, lane=lane)) + '\n')
+        finally:
+            if f is not None:
+                f.close()
+            if encoder is not None:
+                encoded.put(None)
+                encoder.join()
+        return self.stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lane Finding and Vehicle Detection')
+    parser.add_argument('infile', nargs='?', default='VehicleDetection/project_video.mp4', help='Input video.')
+    parser.add_argument('--out', default='project_video_combined.mp4',
+                        help='Path to write the annotated video to.')
+    parser.add_argument('--export', default=None, help='Path to write the per-frame lanes and cars to, as .jsonl.')
+    parser.add_argument('--no-video', action='store_true', help='Only write the structured outputs.')
+    args = parser.parse_args()
+
+    ret, M, dist, rvecs, tvecs = calibrate_camera('/AdvLaneLines/camera_cal/', 9, 6)
+    xmax, ymax = VideoFileClip(args.infile).size
+    src, dst = perspective_points(xmax, ymax)
+
+    runner = RoadRunner(LaneFinder(M, dist, src, dst), load_detector(tracking=True))
+    stats = runner.run(args.infile, None if args.no_video else args.out, args.export)
+
+    print('Processed %d frames at %0.2f fps.' % (stats['frames'], stats['fps']))
+    print('Seconds per frame: undistort %0.4f, cars %0.4f, waiting on the lane %0.4f.'
+          % (stats['undistort_seconds'], stats['cars_seconds'], stats['lane_wait_seconds']))
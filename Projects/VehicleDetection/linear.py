@@ -0,0 +1,117 @@
+import json
+import numpy as np
+
+
+# Version of the files written by `classifier.export_model` and `classifier.export_prefilter`
+MODEL_FORMAT_VERSION = 1
+
+
+class LinearModel(object):
+    def __init__(self, weights, bias):
+        """
+        Linear classifier with the feature scaling folded into its weights and bias, so every window is scored on
+        the raw feature vectors with a single `features @ weights + bias`.
+
+        Features with a zero weight do not affect the score, so they are listed in `support` and need not be
+        computed at all. See `score_support`.
+
+        :param weights: Array of shape (n_features,)
+        :param bias: Scalar bias
+        """
+        self.weights = weights
+        self.bias = bias
+        self.support = np.flatnonzero(weights)
+        self.support_weights = np.ascontiguousarray(weights[self.support])
+
+    def decision_function(self, features):
+        """
+        Scores a batch of raw feature vectors with shape (n, n_features). Positive scores are cars.
+        """
+        return np.dot(features, self.weights) + self.bias
+
+    def score_support(self, features):
+        """
+        Scores a batch of feature vectors which only hold the features in `support`, in order, with shape
+        (n, len(support)).
+        """
+        return np.dot(features, self.support_weights) + self.bias
+
+    def predict(self, features):
+        return (self.decision_function(features) > 0).astype(np.int64)
+
+
+class Prefilter(object):
+    def __init__(self, model, scaler, threshold, spatial_size, hist_bins):
+        """
+        First stage of the detection cascade. A linear model over cheap features, a low resolution spatial binning
+        and the color histograms, which rejects windows whose score falls below a threshold tuned for high recall.
+
+        :param model: Linear model with a `decision_function`.
+        :param scaler: Scaler fit on the cheap features, or None if the scaling is folded into the model, as with
+            `LinearModel`.
+        :param threshold: Windows scoring below this value are rejected.
+        :param spatial_size: Size transform tuple for the spatial features
+        :param hist_bins: Number of histogram bins for color_hist
+        """
+        self.model = model
+        self.scaler = scaler
+        self.threshold = threshold
+        self.spatial_size = spatial_size
+        self.hist_bins = hist_bins
+
+    def keep(self, features):
+        """
+        Returns a boolean mask of the feature vectors which should be passed on to the full classifier.
+
+        :param features: Array of shape (n_windows, n_features), with the spatial features followed by the color
+            histograms.
+        """
+        if self.scaler is not None:
+            features = self.scaler.transform(features)
+        return self.model.decision_function(features) >= self.threshold
+
+
+def _load_linear(path):
+    """
+    Loads the weights and header written for a linear model at `path`, and checks the format version.
+
+    :return: Tuple containing (model, header), where `model` is a `LinearModel` and `header` holds every other
+        entry of the header.
+    """
+    with open(path + '.json', 'r') as f:
+        header = json.load(f)
+
+    version = header.pop('version')
+    if version != MODEL_FORMAT_VERSION:
+        raise ValueError('Unsupported model format version %r, expected %r.' % (version, MODEL_FORMAT_VERSION))
+
+    bias = np.float32(header.pop('bias'))
+    n_features = header.pop('n_features')
+
+    weights = np.load(path + '.npy', mmap_mode='r')
+    assert weights.shape == (n_features,), 'Model weights do not match the header.'
+    return LinearModel(weights, bias), header
+
+
+def load_model(path='VehicleDetection/model'):
+    """
+    Loads a model written by `classifier.export_model`. The weights are memory-mapped rather than read.
+
+    :param path: Path of the model files without an extension
+    :return: Tuple containing (model, params), where `model` is a `LinearModel` and `params` holds the feature
+        parameters the model was trained with.
+    """
+    model, params = _load_linear(path)
+    params['spatial_size'] = tuple(params['spatial_size'])
+    return model, params
+
+
+def load_prefilter(path='VehicleDetection/prefilter'):
+    """
+    Loads a prefilter written by `classifier.export_prefilter`.
+
+    :param path: Path of the prefilter files without an extension
+    :return: The `Prefilter`
+    """
+    model, header = _load_linear(path)
+    return Prefilter(model, None, header['threshold'], tuple(header['spatial_size']), header['hist_bins'])
@@ -0,0 +1,146 @@
+import os
+import glob
+import heapq
+import argparse
+import cv2
+import numpy as np
+from multiprocessing import Pool
+from moviepy.editor import VideoFileClip
+
+from VehicleDetection.pipeline import load_detector
+
+
+# Detector used by the worker processes, set once per process by `_init_worker`
+_detector = None
+
+
+def _init_worker(detector):
+    global _detector
+    _detector = detector
+    # Every frame is searched in full and independently of the others
+    _detector.tracking = False
+
+
+def patch_hash(patch, hash_size=8):
+    """
+    Difference hash of an image patch. Near-duplicate patches, E.G. the same guard rail in consecutive frames, have
+    the same hash.
+
+    :param patch: BGR image
+    :param hash_size: The hash has hash_size**2 bits
+    :return: Hex string of the hash
+    """
+    gray = cv2.cvtColor(patch, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return '%0*x' % (hash_size**2 // 4, int(''.join('1' if b else '0' for b in bits), 2))
+
+
+def _mine_segment(task):
+    """
+    Decodes one segment of a video and returns its highest scoring windows. Every window the model scores above
+    `min_score` is a false positive, as the footage is known to contain no cars.
+
+    :param task: Tuple containing (infile, t_start, t_end, frame_step, min_score, max_patches, patch_size)
+    :return: List of (score, hash, patch) tuples, where `patch` is a BGR image of size `patch_size`.
+    """
+    infile, t_start, t_end, frame_step, min_score, max_patches, patch_size = task
+    clip = VideoFileClip(infile).subclip(t_start, t_end)
+
+    candidates = []
+    for i, im in enumerate(clip.iter_frames()):
+        if i % frame_step != 0:
+            continue
+
+        bboxes, scores = _detector.score_windows(im)
+        for (x_min, y_min, x_max, y_max), score in zip(bboxes, scores):
+            if score <= min_score:
+                continue
+            patch = cv2.resize(im[y_min:y_max, x_min:x_max], patch_size)
+            # Frames are RGB, while the training images are read with `cv2.imread` in BGR
+            patch = cv2.cvtColor(patch, cv2.COLOR_RGB2BGR)
+            candidates.append((float(score), patch_hash(patch), patch))
+
+    return _top_unique(candidates, max_patches)
+
+
+def _top_unique(candidates, max_patches, seen=()):
+    """
+    Keeps the highest scoring candidate for each hash not in `seen`, and then the `max_patches` highest of those.
+    """
+    best = {}
+    for candidate in candidates:
+        score, h, _ = candidate
+        if h not in seen and (h not in best or best[h][0] < score):
+            best[h] = candidate
+    return heapq.nlargest(max_patches, best.values(), key=lambda c: c[0])
+
+
+def mine_hard_negatives(detector,
+                        videos,
+                        out_dir,
+                        n_workers=None,
+                        segment_length=30,
+                        frame_step=1,
+                        min_score=0.,
+                        max_patches=5000,
+                        max_patches_per_segment=200,
+                        patch_size=(64, 64)):
+    """
+    Searches footage that contains no cars for the windows the detector scores highest, and saves them as
+    non-vehicle training images.
+
+    Every video is split into segments of `segment_length` seconds which are decoded and searched independently by
+    a pool of worker processes, so no frames are sent between processes. Patches are deduplicated by their
+    `patch_hash`, both against each other and against the patches already in `out_dir`, and saved as PNGs named
+    after their hash, in the same format as the rest of the `Data` directory.
+
+    :param detector: The `CarDetector` to mine false positives for.
+    :param videos: Paths to videos which contain no cars.
+    :param out_dir: Directory to save the patches to. E.G. `Data/non-vehicles/Mined/`
+    :param n_workers: Number of worker processes. Defaults to the number of CPUs.
+    :param segment_length: Length, in seconds, of the segment each worker searches at a time.
+    :param frame_step: Only search every `frame_step`th frame.
+    :param min_score: Only keep windows the model scores above this value.
+    :param max_patches: Maximum number of patches to save.
+    :param max_patches_per_segment: Maximum number of patches each segment can contribute.
+    :param patch_size: Size of the saved patches.
+    :return: Number of new patches saved.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    seen = set(os.path.splitext(os.path.basename(p))[0] for p in glob.glob(os.path.join(out_dir, '*.png')))
+
+    tasks = []
+    for infile in videos:
+        duration = VideoFileClip(infile).duration
+        for t_start in np.arange(0, duration, segment_length):
+            t_end = min(t_start + segment_length, duration)
+            tasks.append((infile, t_start, t_end, frame_step, min_score, max_patches_per_segment, patch_size))
+
+    candidates = []
+    with Pool(n_workers, initializer=_init_worker, initargs=(detector,)) as pool:
+        for i, segment in enumerate(pool.imap_unordered(_mine_segment, tasks)):
+            # Only ever hold the best `max_patches` candidates in memory
+            candidates = _top_unique(candidates + segment, max_patches, seen)
+            print('Searched %d of %d segments, %d candidates.' % (i + 1, len(tasks), len(candidates)))
+
+    for _, h, patch in candidates:
+        cv2.imwrite(os.path.join(out_dir, h + '.png'), patch)
+    return len(candidates)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hard Negative Mining')
+    parser.add_argument('videos', nargs='+', help='Videos which contain no cars.')
+    parser.add_argument('--out-dir', default='VehicleDetection/Data/non-vehicles/Mined/',
+                        help='Directory to save the patches to.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes.')
+    parser.add_argument('--frame-step', type=int, default=1, help='Only search every nth frame.')
+    parser.add_argument('--max-patches', type=int, default=5000, help='Maximum number of patches to save.')
+    args = parser.parse_args()
+
+    detector = load_detector(tracking=False)
+
+    n_saved = mine_hard_negatives(detector, args.videos, args.out_dir, n_workers=args.workers,
+                                  frame_step=args.frame_step, max_patches=args.max_patches)
+    print('Saved %d new patches to %s' % (n_saved, args.out_dir))
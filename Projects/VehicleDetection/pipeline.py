@@ -1,14 +1,17 @@
 import os
+import time
+import argparse
 import pdb
 import pickle
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.ndimage.measurements import label
-from moviepy.editor import VideoFileClip
+from contextlib import contextmanager
+from scipy.ndimage.measurements import label, find_objects, maximum
 
-import VehicleDetection.classifier as classifier
-from VehicleDetection.processing import bin_spatial, get_hog_features, color_hist
+from VehicleDetection.linear import load_model, load_prefilter
+from VehicleDetection.video import VideoRunner
+from VehicleDetection.processing import bin_spatial, get_hog_features, color_hist, draw_boxes
 
 
 class CarDetector(object):
@@ -25,13 +28,22 @@ class CarDetector(object):
                  spatial_size,
                  hist_bins,
                  frame_memory,
-                 threshold):
+                 threshold,
+                 hog_backend='skimage',
+                 prefilter=None,
+                 tracking=False,
+                 track_margin=32,
+                 n_slices=4,
+                 sweep_every=8,
+                 dtype='float32'):
         """
         This class is meant to take in an image, process it in a predefined way, and return the same image with
         a bounding box around any cars in the image.
 
         :param model: Pre-trained model to identify cars in a ROI.
-        :param scaler: Scaler used to normalize image data when training the model.
+        :param scaler: Scaler used to normalize image data when training the model, or None if the scaling is
+            folded into the model, as with `linear.LinearModel`. Only the features in the `support` of a
+            `LinearModel` are computed.
         :param im_size: Size of image to feed the model.
         :param ystart: Upper bound pixel on Y-axis to search for cars.
         :param ystop: Lower bound pixel on Y-axis to search for cars.
@@ -43,6 +55,17 @@ class CarDetector(object):
         :param hist_bins: Number of histogram bins for color_hist
         :param frame_memory: Number of frames in the past to `remember`. Helps reduce false positives.
         :param threshold: Remove all values less than this threshold from the heatmap. Helps reduce false positives.
+        :param hog_backend: Implementation of HOG to use. Either 'skimage' or 'numpy'. Must match the one used to
+            train the model.
+        :param prefilter: Optional `linear.Prefilter` used to reject windows before their full feature vector is
+            built. Must use the same number of histogram bins as `hist_bins`.
+        :param tracking: Boolean. If true, only search the regions around the cars found in previous frames and one
+            of `n_slices` vertical slices of the search band on each frame, with a full search every `sweep_every`
+            frames to pick up new cars.
+        :param track_margin: Number of pixels to expand the region searched around each tracked car by.
+        :param n_slices: Number of vertical slices to split the search band into when tracking.
+        :param sweep_every: Search the entire band once every this many frames when tracking.
+        :param dtype: Name of the data type of the feature vectors. Must match the one used to train the model.
         """
         self.model = model
         self.scaler = scaler
@@ -57,36 +80,126 @@ class CarDetector(object):
         self.hist_bins = hist_bins
         self.threshold = threshold
         self.frame_memory = frame_memory
+        self.hog_backend = hog_backend
+        self.prefilter = prefilter
+        self.tracking = tracking
+        self.track_margin = track_margin
+        self.n_slices = n_slices
+        self.sweep_every = sweep_every
+        self.dtype = np.dtype(dtype)
         self.frame_buffer = []
+        self.tracks = []
+        self.frame_count = 0
+        self.n_windows = 0
+        # Set to a `defaultdict(float)` to accumulate the seconds spent in each stage of the search
+        self.timings = None
+
+        if prefilter is not None and prefilter.hist_bins != hist_bins:
+            raise ValueError('The prefilter must use the same number of histogram bins as the detector.')
+
+        # The features the model has a nonzero weight for, if it can score a subset of them
+        self.plan = self._feature_plan() if hasattr(model, 'support') else None
 
     def find_cars(self,
                   im):
         """
-        Searches through the Y-range defined in the `init` using 64x64 blocks and steping 16 pixels at a time. Each
-        block is fed through the model, and if the model identifies a car in the block, heat is added to a heatmap in
-        that region. Once the heatmap has been constructed, it is added to the buffer, and averaged heatmap is
-        constructed, and class labels are assigned to the maximums of this heatmap. Using the class labeled mask,
-        bounding boxes are drawn around each class on the original image and this annotated image is returned.
+        Searches the image for cars and returns a copy of it with a bounding box drawn around each detection. See
+        `find_boxes` for a description of the search.
 
         :param im: Original image.
         :return: Annotated image.
         """
-        img = im.astype(np.float32) / 255
-        heatmap = np.zeros_like(img)
+        bboxes = self.find_boxes(im)
+        with self._timed('drawing'):
+            return draw_boxes(im, bboxes)
+
+    def find_boxes(self,
+                   im):
+        """
+        Searches the image for cars and returns their bounding boxes. See `detect`.
+
+        :param im: Original image.
+        :return: List of bounding boxes in the form ((x_min, y_min), (x_max, y_max)).
+        """
+        return self.detect(im)['boxes']
+
+    def detect(self,
+               im):
+        """
+        Searches the image for cars without rendering anything. See `frame_heatmap` for a description of the
+        search and `detections_from_heatmap` for how the detections are found.
+
+        :param im: Original image.
+        :return: Dictionary with keys ['boxes', 'peaks', 'n_windows']. See `detections_from_heatmap`.
+        """
+        heatmap = self.frame_heatmap(im)
+        return self.detections_from_heatmap(heatmap, self.n_windows)
+
+    def frame_heatmap(self,
+                      im):
+        """
+        Scores the search windows of the image with `score_windows`, and adds heat to a heatmap in the region of
+        every window the model identifies as a car.
+
+        Unless tracking, this does not depend on any previous frame, so the heatmaps of several frames can be
+        computed in parallel as long as they are passed to `detections_from_heatmap` in order. The number of
+        windows scored is stored in `n_windows`.
+
+        :param im: Original image.
+        :return: Heatmap for this frame with the same height and width as `im`.
+        """
+        bboxes, scores = self.score_windows(im)
+        return self.windows_heatmap(im.shape[:2], bboxes, scores)
+
+    def windows_heatmap(self,
+                        shape,
+                        bboxes,
+                        scores):
+        """
+        Adds heat to a heatmap in the region of every window with a positive score, as returned by `score_windows`.
 
-        img_tosearch = img[self.ystart:self.ystop, ...]
-        ctrans_tosearch = cv2.cvtColor(img_tosearch, cv2.COLOR_RGB2YCrCb)
-        if self.scale != 1:
-            h, w, ch = ctrans_tosearch.shape
-            ctrans_tosearch = cv2.resize(ctrans_tosearch, (w // self.scale, h // self.scale))
+        :param shape: Height and width of the image.
+        :param bboxes: Array of shape (n, 4) with the (x_min, y_min, x_max, y_max) corners of each window.
+        :param scores: Score of each window.
+        :return: Heatmap with shape `shape`.
+        """
+        with self._timed('heatmap'):
+            # Heat is identical across color channels, so a single channel heatmap is sufficient
+            heatmap = np.zeros(shape, dtype=np.float32)
+            for x_min, y_min, x_max, y_max in bboxes[scores > 0]:
+                self._add_heat(heatmap, ((x_min, y_min), (x_max, y_max)))
+        return heatmap
+
+    def score_windows(self,
+                      im):
+        """
+        Searches through the Y-range defined in the `init` using 64x64 blocks and steping 16 pixels at a time. When
+        tracking, only the blocks near previously found cars and in the current slice of the band are searched. If a
+        prefilter was given, it first rejects the blocks which obviously do not contain a car. Each remaining block
+        is fed through the model, which scores how likely it is to contain a car. Positive scores are cars. With a
+        sparse `linear.LinearModel`, only the features it has a nonzero weight for are extracted.
+
+        :param im: Original image.
+        :return: Tuple containing (bboxes, scores), where `bboxes` is an array of shape (n, 4) with the
+            (x_min, y_min, x_max, y_max) corners of each scored block in the original image.
+        """
+        with self._timed('color_conversion'):
+            img = im.astype(np.float32) / 255
+
+            img_tosearch = img[self.ystart:self.ystop, ...]
+            ctrans_tosearch = cv2.cvtColor(img_tosearch, cv2.COLOR_RGB2YCrCb)
+            if self.scale != 1:
+                h, w, ch = ctrans_tosearch.shape
+                ctrans_tosearch = cv2.resize(ctrans_tosearch, (w // self.scale, h // self.scale))
 
-        ch1 = ctrans_tosearch[:, :, 0]
-        ch2 = ctrans_tosearch[:, :, 1]
-        ch3 = ctrans_tosearch[:, :, 2]
+        plan = self.plan
+        use_spatial = plan is None or plan['spatial'].size > 0
+        use_hist = plan is None or plan['hist'].size > 0
+        channels = [c for c in range(3) if plan is None or plan['hog'][c][0].size > 0]
 
         # Define blocks and steps as above
-        nxblocks = (ch1.shape[1] // self.pix_per_cell) - 1
-        nyblocks = (ch1.shape[0] // self.pix_per_cell) - 1
+        nxblocks = (ctrans_tosearch.shape[1] // self.pix_per_cell) - 1
+        nyblocks = (ctrans_tosearch.shape[0] // self.pix_per_cell) - 1
         # 64 was the orginal sampling rate, with 8 cells and 8 pix per cell
         window = 64
         nblocks_per_window = (window // self.pix_per_cell) - 1
@@ -94,51 +207,231 @@ class CarDetector(object):
         nxsteps = (nxblocks - nblocks_per_window) // cells_per_step
         nysteps = (nyblocks - nblocks_per_window) // cells_per_step
 
-        # Compute individual channel HOG features for the entire image
-        hog1 = get_hog_features(ch1, self.orient, self.pix_per_cell, self.cell_per_block, feature_vec=False)
-        hog2 = get_hog_features(ch2, self.orient, self.pix_per_cell, self.cell_per_block, feature_vec=False)
-        hog3 = get_hog_features(ch3, self.orient, self.pix_per_cell, self.cell_per_block, feature_vec=False)
-
-        for xb in range(nxsteps):
-            for yb in range(nysteps):
-                ypos = yb * cells_per_step
-                xpos = xb * cells_per_step
-                # Extract HOG for this patch
-                hog_feat1 = hog1[ypos:ypos + nblocks_per_window, xpos:xpos + nblocks_per_window].ravel()
-                hog_feat2 = hog2[ypos:ypos + nblocks_per_window, xpos:xpos + nblocks_per_window].ravel()
-                hog_feat3 = hog3[ypos:ypos + nblocks_per_window, xpos:xpos + nblocks_per_window].ravel()
-                hog_features = np.hstack((hog_feat1, hog_feat2, hog_feat3))
-
-                xleft = xpos * self.pix_per_cell
-                ytop = ypos * self.pix_per_cell
-
-                # Extract the image patch
-                subimg = cv2.resize(ctrans_tosearch[ytop:ytop + window, xleft:xleft + window], self.im_size)
-
-                # Get color features
-                spatial_features = bin_spatial(subimg, size=self.spatial_size)
-                hist_features = color_hist(subimg, nbins=self.hist_bins)
-
-                # Scale features and make a prediction
-                test_features = self.scaler.transform(np.hstack((
-                    spatial_features,
-                    hist_features,
-                    hog_features))).reshape(1, -1)
-                # test_features = X_scaler.transform(np.hstack((shape_feat, hist_feat)).reshape(1, -1))
-                test_prediction = self.model.predict(test_features)
-
-                if test_prediction == 1:
-                    xbox_left = np.int(xleft * self.scale)
-                    ytop_draw = np.int(ytop * self.scale)
-                    win_draw = np.int(window * self.scale)
-                    top_left = (xbox_left, ytop_draw + self.ystart)
-                    bottom_right = (xbox_left + win_draw, ytop_draw + win_draw + self.ystart)
-                    self._add_heat(heatmap, (top_left, bottom_right))
-
-        self._add_to_buffer(heatmap)
-        avg_heatmap = self._get_heatmap_from_buffer()
-        labels = label(avg_heatmap)
-        return self._draw_labeled_bounding_boxes(im, labels)
+        # Compute individual channel HOG features for the entire image, skipping any channel the model does not use
+        hogs = [None, None, None]
+        with self._timed('hog'):
+            if self.hog_backend == 'numpy' and channels:
+                # Computes all the channels in a single pass
+                channel_hogs = get_hog_features(ctrans_tosearch[:, :, channels], self.orient, self.pix_per_cell,
+                                                self.cell_per_block, feature_vec=False, backend='numpy')
+            else:
+                channel_hogs = [get_hog_features(ctrans_tosearch[:, :, c], self.orient, self.pix_per_cell,
+                                                 self.cell_per_block, feature_vec=False)
+                                for c in channels]
+
+            # skimage returns float64, which would upcast every feature vector
+            for c, h in zip(channels, channel_hogs):
+                hogs[c] = h.astype(self.dtype, copy=False)
+
+        # Every window position, in cells
+        windows = [(xb * cells_per_step, yb * cells_per_step) for xb in range(nxsteps) for yb in range(nysteps)]
+
+        # Only search near tracked cars and the current slice of the band, unless it is time for a full sweep
+        if self.tracking and self.frame_count % self.sweep_every != 0:
+            windows = self._tracked_windows(windows, window, im.shape[1])
+        self.frame_count += 1
+        self.n_windows = len(windows)
+
+        # Extract the image patches and their color histograms, which are shared by both stages of the cascade
+        with self._timed('color_features'):
+            patches = [cv2.resize(ctrans_tosearch[ypos * self.pix_per_cell:ypos * self.pix_per_cell + window,
+                                                  xpos * self.pix_per_cell:xpos * self.pix_per_cell + window],
+                                  self.im_size)
+                       for xpos, ypos in windows]
+            hist_features = None
+            if use_hist or self.prefilter is not None:
+                hist_features = np.array([color_hist(subimg, nbins=self.hist_bins, dtype=self.dtype)
+                                          for subimg in patches])
+
+        # Reject the windows which obviously do not contain a car using only cheap features
+        if self.prefilter is not None and windows:
+            with self._timed('prefilter'):
+                keep = self.prefilter.keep(np.hstack((
+                    np.array([bin_spatial(subimg, size=self.prefilter.spatial_size) for subimg in patches]),
+                    hist_features)))
+                windows = [win for win, k in zip(windows, keep) if k]
+                patches = [subimg for subimg, k in zip(patches, keep) if k]
+                hist_features = hist_features[keep]
+
+        bboxes = np.zeros((0, 4), dtype=np.int64)
+        scores = np.zeros(0)
+        if windows:
+            # Groups of features in the order the model was trained on, with only the columns the model uses
+            groups = []
+            with self._timed('color_features'):
+                if use_spatial:
+                    spatial_features = np.array([bin_spatial(subimg, size=self.spatial_size) for subimg in patches],
+                                                dtype=self.dtype)
+                    groups.append(spatial_features if plan is None else spatial_features[:, plan['spatial']])
+                if use_hist:
+                    groups.append(hist_features if plan is None else hist_features[:, plan['hist']])
+
+            # Extract HOG for each patch
+            with self._timed('hog'):
+                if plan is None:
+                    groups.append(np.array([np.hstack([
+                        hogs[c][ypos:ypos + nblocks_per_window, xpos:xpos + nblocks_per_window].ravel()
+                        for c in channels])
+                        for xpos, ypos in windows]))
+                else:
+                    # Gather the used entries of every window's blocks at once
+                    xpos, ypos = np.array(windows).T
+                    for c in channels:
+                        dy, dx, rest = plan['hog'][c]
+                        blocks = hogs[c].reshape(hogs[c].shape[0], hogs[c].shape[1], -1)
+                        groups.append(blocks[ypos[:, np.newaxis] + dy, xpos[:, np.newaxis] + dx, rest])
+
+            # Scale features and score every remaining window at once
+            with self._timed('scoring'):
+                # A model without any nonzero weight scores every window with its bias alone
+                test_features = np.hstack(groups) if groups else np.zeros((len(windows), 0), dtype=self.dtype)
+                if plan is not None:
+                    scores = self.model.score_support(test_features)
+                else:
+                    if self.scaler is not None:
+                        test_features = self.scaler.transform(test_features)
+                    scores = self.model.decision_function(test_features)
+
+            # Window corners in the original image
+            positions = np.array(windows) * self.pix_per_cell * self.scale
+            win_draw = int(window * self.scale)
+            xbox_left = positions[:, 0].astype(np.int64)
+            ytop_draw = positions[:, 1].astype(np.int64) + self.ystart
+            bboxes = np.stack((xbox_left, ytop_draw, xbox_left + win_draw, ytop_draw + win_draw), axis=1)
+
+        return bboxes, scores
+
+    def detections_from_heatmap(self,
+                                heatmap,
+                                n_windows=None):
+        """
+        Adds the heatmap of a frame to the buffer, constructs an averaged heatmap, and assigns class labels to the
+        maximums of this heatmap. The tightest bounding box around each labeled class is returned along with the
+        peak value of the averaged heatmap within it.
+
+        :param heatmap: Return value of `frame_heatmap` for the next frame.
+        :param n_windows: Number of windows scored to produce the heatmap.
+        :return: Dictionary with keys:
+            `boxes`: List of bounding boxes in the form ((x_min, y_min), (x_max, y_max)).
+            `peaks`: List with the maximum heat within each box.
+            `n_windows`: The given `n_windows`.
+        """
+        with self._timed('heatmap'):
+            self._add_to_buffer(heatmap)
+            avg_heatmap = self._get_heatmap_from_buffer()
+
+        with self._timed('labelling'):
+            # Heat can only exist within the search band, so only label that region of the heatmap
+            band = avg_heatmap[self.ystart:self.ystop, ...]
+            labels = label(band)
+            bboxes = self._labeled_bounding_boxes(labels, y_offset=self.ystart)
+
+            peaks = []
+            if labels[1] > 0:
+                peaks = [float(peak) for peak in maximum(band, labels[0], np.arange(1, labels[1] + 1))]
+
+        if self.tracking:
+            self._update_tracks(bboxes)
+        return {'boxes': bboxes, 'peaks': peaks, 'n_windows': n_windows}
+
+    def _feature_plan(self):
+        """
+        Splits the `support` of the model into the features of each group, in the order `single_img_features`
+        concatenates them: the spatial features, the color histograms, and the HOG of each channel.
+
+        :return: Dictionary with keys:
+            `spatial`: Indices into the spatial features of one window
+            `hist`: Indices into the color histograms of one window
+            `hog`: For each channel, a tuple of (block_y, block_x, entry) index arrays, locating each used HOG
+                feature by the offset of its block within the window and its entry within the flattened block.
+        """
+        n_spatial = self.spatial_size[0] * self.spatial_size[1] * 3
+        n_hist = 3 * self.hist_bins
+        nblocks_per_window = (64 // self.pix_per_cell) - 1
+        block_shape = (nblocks_per_window, nblocks_per_window, self.cell_per_block**2 * self.orient)
+        n_hog = int(np.prod(block_shape))
+
+        support = self.model.support
+        if self.model.weights.shape[0] != n_spatial + n_hist + 3 * n_hog:
+            raise ValueError('The model does not match the feature parameters of the detector.')
+
+        plan = {'spatial': support[support < n_spatial],
+                'hist': support[(support >= n_spatial) & (support < n_spatial + n_hist)] - n_spatial,
+                'hog': []}
+        for c in range(3):
+            start = n_spatial + n_hist + c * n_hog
+            channel = support[(support >= start) & (support < start + n_hog)] - start
+            plan['hog'].append(np.unravel_index(channel, block_shape))
+        return plan
+
+    def _tracked_windows(self, windows, window, im_width):
+        """
+        Filters the search windows down to those overlapping the expanded region around any tracked car, or lying
+        in the slice of the search band for the current frame. The slices rotate from frame to frame.
+
+        :param windows: List of window positions, in cells, within the search region.
+        :param window: Size of the windows, in pixels, within the search region.
+        :param im_width: Width of the original image.
+        :return: Filtered list of window positions.
+        """
+        if not windows:
+            return windows
+
+        # Window corners in the original image
+        positions = np.array(windows) * self.pix_per_cell * self.scale
+        xleft, ytop = positions[:, 0], positions[:, 1] + self.ystart
+        win_draw = window * self.scale
+
+        current_slice = self.frame_count % self.n_slices
+        keep = (xleft * self.n_slices) // im_width == current_slice
+
+        m = self.track_margin
+        for track in self.tracks:
+            (x_min, y_min), (x_max, y_max) = track['bbox']
+            keep |= ((xleft < x_max + m) & (xleft + win_draw > x_min - m) &
+                     (ytop < y_max + m) & (ytop + win_draw > y_min - m))
+        return [win for win, k in zip(windows, keep) if k]
+
+    def _update_tracks(self, bboxes):
+        """
+        Matches the bounding boxes found in the current frame to the existing tracks by overlap. Matched tracks take
+        the new box, unmatched boxes start new tracks, and tracks unmatched for more than `frame_memory` frames are
+        dropped.
+
+        :param bboxes: List of bounding boxes in the form ((x_min, y_min), (x_max, y_max)).
+        """
+        unmatched = list(bboxes)
+        for track in self.tracks:
+            (tx_min, ty_min), (tx_max, ty_max) = track['bbox']
+            match = None
+            for bbox in unmatched:
+                (x_min, y_min), (x_max, y_max) = bbox
+                if x_min <= tx_max and x_max >= tx_min and y_min <= ty_max and y_max >= ty_min:
+                    match = bbox
+                    break
+
+            if match is None:
+                track['misses'] += 1
+            else:
+                track['bbox'], track['misses'] = match, 0
+                unmatched.remove(match)
+
+        self.tracks = [track for track in self.tracks if track['misses'] <= self.frame_memory]
+        self.tracks.extend({'bbox': bbox, 'misses': 0} for bbox in unmatched)
+
+    @contextmanager
+    def _timed(self, stage):
+        """
+        Adds the time spent within the context to `timings[stage]`, if timings are being recorded.
+        """
+        if self.timings is None:
+            yield
+            return
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - t
 
     def _add_to_buffer(self, heat_map):
         """
@@ -174,28 +467,43 @@ class CarDetector(object):
         return heatmap
 
     @staticmethod
-    def _draw_labeled_bounding_boxes(im, labels):
+    def _labeled_bounding_boxes(labels, y_offset=0):
         """
-        Given a class labeled image mask, find the tightest bounding box around each class, draw these boxes onto the
-        original image, and return the annotated image.
+        Given a class labeled image mask, find the tightest bounding box around each class in a single pass over
+        the mask.
 
-        :param im: Image to draw on
-        :param labels: Pixel-wise class labeled mask of the original image.
+        :param labels: Return value of `scipy.ndimage.measurements.label`.
+        :param y_offset: Number of rows above the labeled region in the original image.
+        :return: List of bounding boxes in the form ((x_min, y_min), (x_max, y_max)).
         """
-        cpy = np.copy(im)
-        for car_number in range(1, labels[1]+1):
-            nonzero = (labels[0] == car_number).nonzero()
-            nonzero_y = np.array(nonzero[0])
-            nonzero_x = np.array(nonzero[1])
+        bboxes = []
+        for y_slice, x_slice in find_objects(labels[0]):
+            top_left = (x_slice.start, y_slice.start + y_offset)
+            bottom_right = (x_slice.stop - 1, y_slice.stop - 1 + y_offset)
+            bboxes.append((top_left, bottom_right))
+        return bboxes
 
-            bbox = ((np.min(nonzero_x), np.min(nonzero_y)), (np.max(nonzero_x), np.max(nonzero_y)))
-            cv2.rectangle(cpy, bbox[0], bbox[1], (0, 0, 255), 6)
-        return cpy
 
+def load_detector(**kwargs):
+    """
+    Loads the model, and the prefilter if it exists, and instantiates a `CarDetector` with the settings used for the
+    project video. The exported model from `classifier.export_model` is preferred, along with the feature parameters
+    stored with it, over the pickled one, and likewise the prefilter from `classifier.export_prefilter`. Neither
+    needs sklearn to load. The model is trained if it has not been yet.
 
-if __name__ == '__main__':
-    # Load the model from the pickle file if it exists, otherwise train it.
-    if os.path.exists('VehicleDetection/model.p'):
+    The detector does not track by default, so `VideoRunner` can search the frames in parallel. Pass
+    `tracking=True` for a detector which searches less of each frame, but which has to run serially.
+
+    :param kwargs: Any `CarDetector` arguments to override.
+    :return: The `CarDetector`
+    """
+    model_params = {}
+
+    # Load the model from the exported or pickle file if it exists, otherwise train it.
+    if os.path.exists('VehicleDetection/model.json'):
+        model, model_params = load_model('VehicleDetection/model')
+        X_scaler = None
+    elif os.path.exists('VehicleDetection/model.p'):
         print('Loading the model from the pickled file...')
 
         with open('VehicleDetection/model.p', 'rb') as f:
@@ -203,10 +511,18 @@ if __name__ == '__main__':
 
         print('Done!')
     else:
-        model, X_scaler = classifier.train()
+        # Only training needs sklearn, so it is not imported otherwise
+        from VehicleDetection.classifier import train
+        model, X_scaler = train()
 
-    # Instantiate the detector
-    detector = CarDetector(
+    prefilter = None
+    if os.path.exists('VehicleDetection/prefilter.json'):
+        prefilter = load_prefilter('VehicleDetection/prefilter')
+    elif os.path.exists('VehicleDetection/prefilter.p'):
+        with open('VehicleDetection/prefilter.p', 'rb') as f:
+            prefilter = pickle.load(f)
+
+    settings = dict(
         model=model,
         scaler=X_scaler,
         im_size=(64, 64),
@@ -219,12 +535,37 @@ if __name__ == '__main__':
         spatial_size=(32, 32),
         hist_bins=32,
         frame_memory=5,
-        threshold=1)
+        threshold=1,
+        prefilter=prefilter)
+
+    # The detector must extract the same features the model was trained on
+    for key in ['orient', 'pix_per_cell', 'cell_per_block', 'spatial_size', 'hist_bins', 'hog_backend', 'dtype']:
+        if key in model_params:
+            settings[key] = model_params[key]
+    settings.update(kwargs)
+    return CarDetector(**settings)
 
+
+if __name__ == '__main__':
     infile = 'VehicleDetection/project_video.mp4'
     outfile = 'VehicleDetection/project_video_output.mp4'
 
+    parser = argparse.ArgumentParser(description='Vehicle Detection')
+    parser.add_argument('--export', default=None,
+                        help='Write the detections to this .jsonl or .npz file instead of rendering a video.')
+    parser.add_argument('--tracking', action='store_true',
+                        help='Only search around tracked cars. Frames are then searched serially.')
+    args = parser.parse_args()
+
+    # Instantiate the detector
+    detector = load_detector(tracking=args.tracking)
+
     # Load and process the video
-    original = VideoFileClip(infile)
-    processed = original.fl_image(detector.find_cars)
-    processed.write_videofile(outfile, audio=False)
+    runner = VideoRunner(detector)
+    if args.export is not None:
+        stats = runner.export(infile, args.export)
+    else:
+        stats = runner.run(infile, outfile)
+    print('Processed %d frames at %0.2f fps.' % (stats['frames'], stats['fps']))
+    print('Mean queue occupancy: decoded %0.1f, encoded %0.1f, in flight %0.1f.'
+          % (stats['decoded_queue'], stats.get('encoded_queue', 0), stats['in_flight']))
@@ -2,24 +2,45 @@ import os
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
-import sklearn
 import pdb
+import inspect
+from collections import OrderedDict
+from functools import partial, lru_cache
+from multiprocessing import Pool
+from numpy.lib.stride_tricks import as_strided
 from skimage.feature import hog
 
+from VehicleDetection.archive import ImageArchive
+from VehicleDetection.cache import FeatureCache
+
 
 # Define a function to return HOG features and visualization
 def get_hog_features(img, orient=9, pix_per_cell=8, cell_per_block=2,
-                     vis=False, feature_vec=True):
+                     vis=False, feature_vec=True, backend='skimage'):
     """
     Takes in a color channel of an image and returns the HOG features and optionally a visualization.
 
+    With the 'numpy' backend, `img` may also have several color channels, in which case the features of every
+    channel are computed in one pass by `hog_channels`.
+
     :param img: Single color channel image
     :param orient: Number of bins to group the gradients for each cell
     :param pix_per_cell: Number of pixels per cell
     :param cell_per_block: Number of cells ber block
     :param vis: Boolean. Returns `features, hog_image` instead of only `features` if true.
     :param feature_vec: Boolean. Whether or not to flatten the HOG features.
+    :param backend: Either 'skimage' or 'numpy'. The 'numpy' backend does not support `vis`.
     """
+    if backend == 'numpy':
+        if vis:
+            raise ValueError("The 'numpy' HOG backend cannot produce a visualization.")
+        features = hog_channels(img, orient, pix_per_cell, cell_per_block, feature_vec=feature_vec)
+        if img.ndim == 2 and not feature_vec:
+            return features[0]
+        return features
+    elif backend != 'skimage':
+        raise ValueError("Argument `backend` must be 'skimage' or 'numpy'.")
+
     if vis:
         features, hog_image = hog(
             img,
@@ -42,6 +63,84 @@ def get_hog_features(img, orient=9, pix_per_cell=8, cell_per_block=2,
         return features
 
 
+@lru_cache(maxsize=8)
+def _hog_bin_offsets(n_cells_y, n_cells_x, pix_per_cell, n_channels, orient):
+    """
+    For every pixel and channel of a cropped image, the index of its cell's first orientation bin in a flattened
+    (n_cells_y, n_cells_x, n_channels, orient) histogram. Cached, as it only depends on the image shape.
+    """
+    cell_y = np.arange(n_cells_y * pix_per_cell) // pix_per_cell
+    cell_x = np.arange(n_cells_x * pix_per_cell) // pix_per_cell
+    cell = cell_y[:, np.newaxis] * n_cells_x + cell_x[np.newaxis, :]
+    offsets = (cell[..., np.newaxis] * n_channels + np.arange(n_channels)) * orient
+    offsets.flags.writeable = False
+    return offsets
+
+
+def hog_channels(img, orient=9, pix_per_cell=8, cell_per_block=2, feature_vec=True, eps=1e-5):
+    """
+    Vectorised HOG over every color channel of an image at once.
+
+    Reproduces `skimage.feature.hog` with `transform_sqrt=True` and L1 block normalisation: centered gradients, hard
+    orientation binning over [0, 180) degrees, and cell histograms averaged over the cell area. The gradients of
+    all channels are computed together, every cell histogram is accumulated with a single `np.bincount`, and the
+    blocks are normalised with strided views instead of a loop per block.
+
+    :param img: Image with shape (h, w) or (h, w, ch)
+    :param orient: Number of bins to group the gradients for each cell
+    :param pix_per_cell: Number of pixels per cell
+    :param cell_per_block: Number of cells ber block
+    :param feature_vec: Boolean. Whether or not to flatten the HOG features.
+    :param eps: Numerical stability constant for the block normalisation
+    :return: If `feature_vec`, the flattened features of each channel concatenated in channel order. Otherwise an
+        array with shape (ch, n_blocks_y, n_blocks_x, cell_per_block, cell_per_block, orient).
+    """
+    if img.ndim == 2:
+        img = img[..., np.newaxis]
+    img = np.sqrt(img.astype(np.float32))
+    h, w, n_channels = img.shape
+
+    gx = np.zeros_like(img)
+    gy = np.zeros_like(img)
+    gx[:, 1:-1] = img[:, 2:] - img[:, :-2]
+    gy[1:-1, :] = img[2:, :] - img[:-2, :]
+
+    # Only pixels within a whole cell contribute to the histograms
+    n_cells_y, n_cells_x = h // pix_per_cell, w // pix_per_cell
+    gx = gx[:n_cells_y * pix_per_cell, :n_cells_x * pix_per_cell]
+    gy = gy[:n_cells_y * pix_per_cell, :n_cells_x * pix_per_cell]
+
+    magnitude = np.hypot(gx, gy)
+    orientation = np.rad2deg(np.arctan2(gy, gx)) % 180
+    bins = np.minimum((orientation * (orient / 180.)).astype(np.intp), orient - 1)
+
+    offsets = _hog_bin_offsets(n_cells_y, n_cells_x, pix_per_cell, n_channels, orient)
+    hist = np.bincount((offsets + bins).ravel(), weights=magnitude.ravel(),
+                       minlength=n_cells_y * n_cells_x * n_channels * orient)
+    hist = hist.reshape(n_cells_y, n_cells_x, n_channels, orient).transpose(2, 0, 1, 3)
+    hist = np.ascontiguousarray(hist, dtype=np.float32) / pix_per_cell**2
+
+    # View every block as a window over the cell histograms: (ch, n_blocks_y, n_blocks_x, cpb, cpb, orient)
+    n_blocks_y = n_cells_y - cell_per_block + 1
+    n_blocks_x = n_cells_x - cell_per_block + 1
+    s = hist.strides
+    blocks = as_strided(hist,
+                        shape=(n_channels, n_blocks_y, n_blocks_x, cell_per_block, cell_per_block, orient),
+                        strides=(s[0], s[1], s[2], s[1], s[2], s[3]))
+
+    # L1 norm of each block from the sums of its cells
+    cell_sums = hist.sum(axis=3)
+    block_sums = np.zeros((n_channels, n_blocks_y, n_blocks_x), dtype=np.float32)
+    for y in range(cell_per_block):
+        for x in range(cell_per_block):
+            block_sums += cell_sums[:, y:y + n_blocks_y, x:x + n_blocks_x]
+
+    features = blocks / (block_sums[..., np.newaxis, np.newaxis, np.newaxis] + eps)
+    if feature_vec:
+        return features.ravel()
+    return features
+
+
 # Define a function to compute binned color features
 def bin_spatial(img, size=(16, 16)):
     """
@@ -58,12 +157,14 @@ def bin_spatial(img, size=(16, 16)):
 
 # Define a function to compute color histogram features
 # NEED TO CHANGE bins_range if reading .png files with mpimg!
-def color_hist(img, nbins=32):
+def color_hist(img, nbins=32, dtype=np.float32):
     """
     Compute the histogram of color intensity for each channel of the image.
 
     :param img: Input image
     :param nbins: Number of histogram bins for each image
+    :param dtype: Data type of the returned counts, so they can be stacked with the other features without
+        upcasting them.
     :return: Array of len 3*nbins
     """
     # Compute the histogram of the color channels separately
@@ -71,7 +172,7 @@ def color_hist(img, nbins=32):
     channel2_hist = np.histogram(img[:, :, 1], bins=nbins)
     channel3_hist = np.histogram(img[:, :, 2], bins=nbins)
     # Concatenate the histograms into a single feature vector
-    hist_features = np.concatenate((channel1_hist[0], channel2_hist[0], channel3_hist[0]))
+    hist_features = np.concatenate((channel1_hist[0], channel2_hist[0], channel3_hist[0])).astype(dtype)
     # Return the individual histograms, bin_centers and feature vector
     return hist_features
 
@@ -85,9 +186,11 @@ def single_img_features(img,
                         pix_per_cell=8,
                         cell_per_block=2,
                         hog_channel='ALL',
+                        hog_backend='skimage',
                         spatial_feat=True,
                         hist_feat=True,
-                        hog_feat=True):
+                        hog_feat=True,
+                        dtype='float32'):
     """
     Function to apply all feature analyses and concatenate their results.
 
@@ -100,10 +203,13 @@ def single_img_features(img,
     :param pix_per_cell: For HOG features
     :param cell_per_block: For HOG features
     :param hog_channel: Channel number to perform HOG analysis on. Can be 'ALL'.
+    :param hog_backend: Implementation of HOG to use. Either 'skimage' or 'numpy'.
     :param spatial_feat: Boolean.
     :param hist_feat: Boolean.
     :param hog_feat: Boolean.
-    :return:
+    :param dtype: Name of the data type of the feature vector. Every group of features is cast to it before they
+        are concatenated, so a float64 HOG never upcasts the whole vector.
+    :return: Contiguous feature vector of type `dtype`
     """
     # 1) Define an empty list to receive features
     img_features = []
@@ -130,46 +236,143 @@ def single_img_features(img,
         img_features.append(spatial_features)
     # 5) Compute histogram features if flag is set
     if hist_feat:
-        hist_features = color_hist(feature_image, nbins=hist_bins)
+        hist_features = color_hist(feature_image, nbins=hist_bins, dtype=dtype)
         # 6) Append features to list
         img_features.append(hist_features)
     # 7) Compute HOG features if flag is set
     if hog_feat:
         if hog_img is not None:
-            hog_features = []
-            for channel in range(hog_img.shape[2]):
-                hog_features.extend(hog_img[..., channel].ravel())
+            hog_features = np.concatenate([hog_img[..., channel].ravel() for channel in range(hog_img.shape[2])])
+        elif hog_channel == 'ALL' and hog_backend == 'numpy':
+            hog_features = get_hog_features(feature_image, orient, pix_per_cell, cell_per_block,
+                                            vis=False, feature_vec=True, backend=hog_backend)
         elif hog_channel == 'ALL':
-            hog_features = []
-            for channel in range(feature_image.shape[2]):
-                hog_features.extend(get_hog_features(feature_image[..., channel],
-                                    orient, pix_per_cell, cell_per_block,
-                                    vis=False, feature_vec=True))
+            hog_features = np.concatenate([get_hog_features(feature_image[..., channel],
+                                                            orient, pix_per_cell, cell_per_block,
+                                                            vis=False, feature_vec=True)
+                                           for channel in range(feature_image.shape[2])])
         else:
             hog_features = get_hog_features(feature_image[..., hog_channel],
                                             orient,
                                             pix_per_cell,
                                             cell_per_block,
                                             vis=False,
-                                            feature_vec=True)
+                                            feature_vec=True,
+                                            backend=hog_backend)
 
         # 8) Append features to list
         img_features.append(hog_features)
 
     # 9) Return concatenated array of features
-    return np.concatenate(img_features)
+    return np.concatenate([np.asarray(features, dtype=dtype) for features in img_features])
 
 
-def extract_features(imgs):
+def default_feature_params():
     """
-    Extract features from an array of images.
+    Returns the default keyword arguments of `single_img_features`, excluding the precomputed HOG image.
     """
-    features = []
-    for file in imgs:
-        image = cv2.imread(file)
-        image = image.astype(np.float32) / 255
-        features.append(single_img_features(image))
-    return features
+    signature = inspect.signature(single_img_features)
+    return {name: p.default for name, p in signature.parameters.items()
+            if p.default is not inspect.Parameter.empty and name != 'hog_img'}
+
+
+def _extract_file_features(file, params):
+    """
+    Reads an image from disk and extracts its features. Defined at the module level so it can be sent to workers.
+    """
+    image = cv2.imread(file)
+    image = image.astype(np.float32) / 255
+    return single_img_features(image, **params)
+
+
+def _extract_archive_features(i, archive, params):
+    """
+    Extracts the features of the `i`th image of an `ImageArchive`.
+    """
+    image = archive.images[i].astype(np.float32) / 255
+    return single_img_features(image, **params)
+
+
+def _extractor(imgs, params):
+    """
+    Builds the picklable per-image extraction function for `imgs`.
+
+    :return: Tuple containing (keys, mtimes, items, extract), where `extract(items[key])` returns the features of
+        the image identified by `key`.
+    """
+    if isinstance(imgs, ImageArchive):
+        # Workers receive only the archive path and memory-map the images themselves
+        keys, mtimes = list(imgs.paths), list(imgs.mtimes)
+        items = dict(zip(keys, range(len(imgs))))
+        extract = partial(_extract_archive_features, archive=imgs, params=params)
+    else:
+        keys, mtimes = list(imgs), None
+        items = dict(zip(keys, keys))
+        extract = partial(_extract_file_features, params=params)
+    return keys, mtimes, items, extract
+
+
+def cache_features(imgs, cache_dir, n_jobs=None, **params):
+    """
+    Ensures the features of every image are in the `FeatureCache` at `cache_dir` without loading them.
+
+    Entries are keyed by each image's path and modification time along with `params`, and only the images missing
+    from the cache are extracted, across a pool of `n_jobs` processes. Images from an archive are keyed by the paths
+    they were packed from.
+
+    :param imgs: Image file paths, or an `ImageArchive`
+    :param cache_dir: Directory to cache the features in.
+    :param n_jobs: Number of worker processes. Defaults to the number of CPUs.
+    :param params: Any keyword arguments for `single_img_features`.
+    :return: Tuple containing (cache, keys), where `cache.gather(keys)` returns the features of `imgs` in order.
+    """
+    # Resolve every feature parameter so that the cache key does not depend on which ones were passed explicitly
+    params = dict(default_feature_params(), **params)
+    keys, mtimes, items, extract = _extractor(imgs, params)
+
+    cache = FeatureCache(cache_dir, params)
+    # Drop duplicate paths so each image is only extracted once
+    missing = list(OrderedDict.fromkeys(cache.missing(keys, mtimes)))
+
+    if missing:
+        missing_mtimes = None
+        if mtimes is not None:
+            mtime_of = dict(zip(keys, mtimes))
+            missing_mtimes = [mtime_of[k] for k in missing]
+
+        # Extract the first image to find the length and type of the feature vectors
+        first = extract(items[missing[0]])
+        chunk = cache.new_chunk(missing, first.shape[0], first.dtype)
+        chunk[0] = first
+
+        with Pool(n_jobs) as pool:
+            for i, features in enumerate(pool.imap(extract, [items[k] for k in missing[1:]], chunksize=64)):
+                chunk[i + 1] = features
+        cache.commit(missing, chunk, missing_mtimes)
+    return cache, keys
+
+
+def extract_features(imgs, n_jobs=None, cache_dir=None, **params):
+    """
+    Extract features from an array of image paths or a packed `ImageArchive`.
+
+    Extraction is spread across a pool of `n_jobs` processes. If `cache_dir` is given, the features are read from
+    and added to a `FeatureCache`. See `cache_features`.
+
+    :param imgs: Image file paths, or an `ImageArchive`
+    :param n_jobs: Number of worker processes. Defaults to the number of CPUs.
+    :param cache_dir: Optional directory to cache the features in.
+    :param params: Any keyword arguments for `single_img_features`.
+    :return: Contiguous array of shape (len(imgs), n_features), of the `dtype` passed to `single_img_features`.
+    """
+    if cache_dir is not None:
+        cache, keys = cache_features(imgs, cache_dir, n_jobs, **params)
+        return cache.gather(keys)
+
+    params = dict(default_feature_params(), **params)
+    keys, _, items, extract = _extractor(imgs, params)
+    with Pool(n_jobs) as pool:
+        return np.array(pool.map(extract, [items[k] for k in keys], chunksize=64), dtype=params['dtype'])
 
 
 def draw_boxes(img, bboxes, color=(0, 0, 255), thick=6):
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+from collections import deque
+from multiprocessing import Pool
+from queue import Queue
+from moviepy.editor import VideoFileClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+from VehicleDetection.processing import draw_boxes
+
+
+# Detector used by the worker processes, set once per process by `_init_worker`
+_detector = None
+
+
+def _init_worker(detector):
+    global _detector
+    _detector = detector
+
+
+def _worker_windows(im):
+    # Only the positive windows are sent back, which is far less to pickle than a heatmap of the whole frame
+    bboxes, scores = _detector.score_windows(im)
+    positive = scores > 0
+    return bboxes[positive], scores[positive], _detector.n_windows
+
+
+class VideoRunner(object):
+    def __init__(self, detector, n_workers=None, queue_size=16):
+        """
+        Runs a `CarDetector` over a video with decoding and detection overlapped. A decoder thread is connected to
+        the detection stage by a bounded queue, and the per-frame detections are streamed to a consumer: either
+        `run`, which renders them into a video on an encoder thread, or `export`, which only writes the detections.
+
+        The windows of each frame do not depend on the previous frames, so they are scored by a pool of `n_workers`
+        processes with up to twice that many frames in flight. The workers return the windows scored as cars, whose
+        heatmaps are built and passed to the detector in frame order, so the heatmap history is the same as when
+        running serially. A tracking detector depends on the
+        previous frame, so it runs in the detection stage itself, and only the decoding and the consumer are
+        overlapped.
+
+        :param detector: The `CarDetector` to run.
+        :param n_workers: Number of worker processes. Defaults to the number of CPUs.
+        :param queue_size: Maximum number of frames waiting in each queue.
+        """
+        self.detector = detector
+        self.n_workers = n_workers
+        self.queue_size = queue_size
+        self.stats = {}
+
+    def stream(self, infile):
+        """
+        Decodes and searches every frame of `infile`, yielding each frame with its detections in frame order. Once
+        the stream is exhausted, `stats` holds the number of frames, frames per second, and the mean occupancy of
+        the decoded queue and of the frames in flight in the pool.
+
+        :param infile: Path to the input video.
+        :return: Generator of (frame, detections) tuples, where `detections` is the return value of
+            `CarDetector.detections_from_heatmap`.
+        """
+        clip = VideoFileClip(infile)
+        decoded = Queue(self.queue_size)
+        occupancy = {'decoded': [], 'in_flight': []}
+
+        # A daemon, so a consumer which stops early does not leave it blocked forever
+        decoder = threading.Thread(target=self._decode, args=(clip, decoded), daemon=True)
+
+        t = time.time()
+        decoder.start()
+
+        n_frames = 0
+        frames = iter(decoded.get, None)
+        if self.detector.tracking:
+            for im in frames:
+                occupancy['decoded'].append(decoded.qsize())
+                n_frames += 1
+                yield im, self.detector.detect(im)
+        else:
+            n_workers = self.n_workers or os.cpu_count()
+            with Pool(n_workers, initializer=_init_worker, initargs=(self.detector,)) as pool:
+                # Keep every worker busy while the oldest frame is being finished
+                n_in_flight = 2 * n_workers
+                in_flight = deque()
+
+                for im in frames:
+                    in_flight.append((im, pool.apply_async(_worker_windows, (im,))))
+                    occupancy['decoded'].append(decoded.qsize())
+                    occupancy['in_flight'].append(len(in_flight))
+
+                    # Finish the oldest frame once enough frames are being processed
+                    if len(in_flight) >= n_in_flight:
+                        n_frames += 1
+                        yield self._finish(in_flight.popleft())
+
+                while in_flight:
+                    n_frames += 1
+                    yield self._finish(in_flight.popleft())
+
+        decoder.join()
+        t = time.time() - t
+
+        self.stats = {
+            'frames': n_frames,
+            'fps': n_frames / t,
+            'decoded_queue': float(np.mean(occupancy['decoded'] or [0])),
+            'in_flight': float(np.mean(occupancy['in_flight'] or [0]))
+          }
+
+    def run(self, infile, outfile):
+        """
+        Annotates every frame of `infile` with the detected cars and writes the result to `outfile`.
+
+        :param infile: Path to the input video.
+        :param outfile: Path to write the annotated video to.
+        :return: `stats`, with the mean occupancy of the encoder queue added.
+        """
+        clip = VideoFileClip(infile)
+        encoded = Queue(self.queue_size)
+        encoder = threading.Thread(target=self._encode, args=(clip, outfile, encoded))
+        encoder.start()
+
+        occupancy = []
+        try:
+            for im, detections in self.stream(infile):
+                encoded.put(draw_boxes(im, detections['boxes']))
+                occupancy.append(encoded.qsize())
+        finally:
+            encoded.put(None)
+            encoder.join()
+
+        self.stats['encoded_queue'] = float(np.mean(occupancy or [0]))
+        return self.stats
+
+    def export(self, infile, outfile):
+        """
+        Writes the detections for every frame of `infile` to `outfile` without rendering any frames.
+
+        If `outfile` ends with `.jsonl`, one JSON object with keys ['frame', 'boxes', 'peaks', 'n_windows'] is
+        written per frame as it is produced. If it ends with `.npz`, the arrays below are written at the end:
+            `frames`: Frame index of each box
+            `boxes`: Array of shape (n_boxes, 4) with (x_min, y_min, x_max, y_max)
+            `peaks`: Maximum heat within each box
+            `n_windows`: Number of windows scored in each frame
+
+        :param infile: Path to the input video.
+        :param outfile: Path to write the detections to.
+        :return: `stats`
+        """
+        if outfile.endswith('.jsonl'):
+            with open(outfile, 'w') as f:
+                for i, (_, detections) in enumerate(self.stream(infile)):
+                    record = dict(detections, frame=i)
+                    f.write(json.dumps(record) + '\n')
+        elif outfile.endswith('.npz'):
+            frames, boxes, peaks, n_windows = [], [], [], []
+            for i, (_, detections) in enumerate(self.stream(infile)):
+                for ((x_min, y_min), (x_max, y_max)), peak in zip(detections['boxes'], detections['peaks']):
+                    frames.append(i)
+                    boxes.append((x_min, y_min, x_max, y_max))
+                    peaks.append(peak)
+                n_windows.append(detections['n_windows'])
+
+            np.savez(outfile,
+                     frames=np.array(frames, dtype=np.int32),
+                     boxes=np.array(boxes, dtype=np.int32).reshape(-1, 4),
+                     peaks=np.array(peaks, dtype=np.float32),
+                     n_windows=np.array(n_windows, dtype=np.int32))
+        else:
+            raise ValueError('Argument `outfile` must end with .jsonl or .npz.')
+        return self.stats
+
+    def _finish(self, frame):
+        """
+        Waits for a frame's car windows, and builds its heatmap and finds its detections in order.
+        """
+        im, result = frame
+        bboxes, scores, n_windows = result.get()
+        heatmap = self.detector.windows_heatmap(im.shape[:2], bboxes, scores)
+        return im, self.detector.detections_from_heatmap(heatmap, n_windows)
+
+    @staticmethod
+    def _decode(clip, decoded):
+        """
+        Decodes every frame of the clip into the queue, followed by `None`.
+        """
+        try:
+            for im in clip.iter_frames():
+                decoded.put(im)
+        finally:
+            decoded.put(None)
+
+    @staticmethod
+    def _encode(clip, outfile, encoded):
+        """
+        Writes every frame from the queue to `outfile` until it receives `None`.
+        """
+        writer = FFMPEG_VideoWriter(outfile, clip.size, clip.fps)
+        try:
+            for im in iter(encoded.get, None):
+                writer.write_frame(im)
+        finally:
+            writer.close()